@@ -12,7 +12,52 @@ configs = {
         'port': 3306,
         'user': 'webapp',
         'password': '0506',
-        'database': 'awesome'
+        'database': 'awesome',
+        # 数据库驱动：'mysql'（aiomysql）或 'sqlite'（aiosqlite，database 为文件路径或 ':memory:'），见 backends.py
+        'backend': 'mysql',
+        # 连接池：启动时预先打开 minsize 个连接，最多 maxsize 个
+        'minsize': 1,
+        'maxsize': 10,
+        # 连接打开超过这个时间（秒）后重建，要小于 mysql 的 wait_timeout
+        'recycle': 3600,
+        # 空闲超过这个时间（秒）的连接借出前先 ping
+        'ping_interval': 30,
+        # 等待空闲连接的最长时间（秒），超时返回 503
+        'acquire_timeout': 5,
+        # 按等待时间在 minsize 和 adaptive_maxsize 之间自动调整 maxsize
+        'adaptive': False,
+        'adaptive_maxsize': 50,
+        # 平均等待时间超过这个值（秒）时增大连接池
+        'adaptive_wait': 0.005,
+        # 只读副本：名字 => 和主库不同的配置项，查询发给副本，写入和事务发给主库
+        # 例如 {'replica1': {'host': '10.0.0.2'}}
+        'replicas': {},
+        # 选择副本的方式：'round_robin' 或 'least_busy'
+        'routing': 'round_robin',
+        # 一个请求写入后，后面的查询都发给主库
+        'sticky': True,
+        # 分片组：组名 => 每个分片和主库不同的配置项，Model 的 __shards__ 指定组名
+        # 例如 {'comments': [{'database': 'awesome_c0'}, {'database': 'awesome_c1'}]}
+        'shards': {}
+    },
+    'web': {
+        'host': '127.0.0.1',
+        'port': 9000,
+        # launcher.py 启动的工作进程数，0 表示和 CPU 核数相同
+        'workers': 0,
+        # 收到 SIGTERM 后等待处理中的请求完成的最长时间（秒）
+        'shutdown_timeout': 60,
+        # 生产模式：jinja2 不检查模版修改，使用字节码缓存并在启动时预先编译
+        'production': False,
+        # 安装了 uvloop 时使用 uvloop 的事件循环
+        'uvloop': False
+    },
+    'log': {
+        'level': 'INFO',
+        # 每条日志输出为一行 JSON
+        'json_format': True,
+        # SQL 日志的抽样比例，1 表示全部输出，0 表示关闭
+        'sql_sample_rate': 0.01
     },
     'session': {
         'secret': ''
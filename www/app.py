@@ -10,26 +10,52 @@
 import time
 import json
 import os
+import sys
+import hashlib
+import math
 import orm
+import serializer
+import compress
+import metrics
+import applog
 from coroweb import add_routes, add_static
+from router import TrieRouter
 from aiohttp import web
 from datetime import datetime
 import asyncio
-from jinja2 import Environment, FileSystemLoader
+from jinja2 import Environment, FileSystemLoader, FileSystemBytecodeCache
+from templating import FragmentCacheExtension
 import logging
 logging.basicConfig(level=logging.INFO)
 
+# conf 在项目根目录下
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from conf.config import configs
+
+
+# production=True 时：
+# 1. 不再检查模版文件是否修改（auto_reload=False）
+# 2. 编译后的字节码保存在 bytecode_cache_dir（默认系统临时目录），新启动的进程不用重新编译
+# 3. 启动时预先编译 templates 下所有模版
+
 
 def init_jinja2(app, **kw):
     logging.info('init jinja2...')
+    production = kw.get('production', False)
     options = dict(
         autoescape=kw.get('autoescape', True),
         block_start_string=kw.get('block_start_string', '{%'),
         block_end_string=kw.get('block_end_string', '%}'),
         variable_start_string=kw.get('variable_start_string', '{{'),
         variable_end_string=kw.get('variable_end_string', '}}'),
-        auto_reload=kw.get('auto_reload', True)
+        auto_reload=kw.get('auto_reload', not production),
+        # {% cache %} 片段缓存，见 templating.py
+        extensions=[FragmentCacheExtension]
     )
+    if production:
+        options['bytecode_cache'] = FileSystemBytecodeCache(kw.get('bytecode_cache_dir', None))
+        # 模版数量不多，全部保留在内存中
+        options['cache_size'] = -1
     path = kw.get('path', None)
     if path is None:
         path = os.path.join(os.path.dirname(
@@ -40,6 +66,11 @@ def init_jinja2(app, **kw):
     if filters is not None:
         for name, f in filters.items():
             env.filters[name] = f
+    if production:
+        names = env.list_templates()
+        for name in names:
+            env.get_template(name)
+        logging.info('precompiled %s templates' % len(names))
     app['__templating__'] = env
 
 
@@ -47,17 +78,154 @@ async def logger_factory(app, handler):
 
     async def logger(request):
         # 记录日志:
-        logging.info('Request: %s %s' % (request.method, request.path))
+        logging.info('Request: %s %s', request.method, request.path)
         # 继续处理请求:
         return (await handler(request))
     return logger
 
 
+# 条件请求：响应带上 ETag / Last-Modified，客户端再次请求时带 If-None-Match / If-Modified-Since
+# 内容没有变化就返回 304，不再发送 body
+# 1. handler 返回的 dict 中可以给出 '__etag__' 或 '__last_modified__'（时间戳，例如这些行中最大的 created_at），
+#    response_factory 在渲染模版、编码 JSON 之前就比较，命中时连序列化都省掉
+# 2. 其余 GET/HEAD 的 200 响应由 conditional_factory 按编码后的 body 计算强 ETag，命中时只省掉传输
+
+
+def quote_etag(etag):
+    ' return etag as a quoted entity tag, leaving already quoted or weak tags untouched. '
+    etag = str(etag)
+    if etag.startswith('"') or etag.startswith('W/"'):
+        return etag
+    return '"%s"' % etag
+
+
+def _opaque_tag(etag):
+    # If-None-Match 使用弱比较：忽略 W/ 前缀
+    return etag[2:] if etag.startswith('W/') else etag
+
+
+def not_modified(request, etag=None, last_modified=None):
+    ' check the request validators, True when the client copy is still fresh. '
+    if request.method not in ('GET', 'HEAD'):
+        return False
+    inm = request.headers.get('If-None-Match')
+    if inm is not None:
+        # 同时带有 If-None-Match 时忽略 If-Modified-Since
+        if etag is None:
+            return False
+        if inm.strip() == '*':
+            return True
+        tag = _opaque_tag(etag)
+        return any(_opaque_tag(t.strip()) == tag for t in inm.split(','))
+    if last_modified is None:
+        return False
+    ims = request.if_modified_since
+    if ims is None:
+        return False
+    if isinstance(last_modified, datetime):
+        last_modified = last_modified.timestamp()
+    # HTTP 日期只精确到秒，和 aiohttp 生成 Last-Modified 时一样向上取整
+    return math.ceil(last_modified) <= ims.timestamp()
+
+
+def set_validators(resp, etag=None, last_modified=None):
+    if etag is not None:
+        resp.headers['ETag'] = etag
+    if last_modified is not None:
+        resp.last_modified = last_modified
+    return resp
+
+
+def not_modified_response(etag=None, last_modified=None):
+    return set_validators(web.Response(status=304), etag, last_modified)
+
+
+def weaken_etag(resp):
+    etag = resp.headers.get('ETag')
+    if etag is not None and not etag.startswith('W/'):
+        resp.headers['ETag'] = 'W/' + etag
+    return resp
+
+
+async def conditional_factory(app, handler):
+    async def conditional(request):
+        r = await handler(request)
+        # 只处理完整生成好的 200 响应；流式响应的头已经发出去了
+        if request.method not in ('GET', 'HEAD') or not isinstance(r, web.Response) or r.status != 200:
+            return r
+        body = r.body
+        etag = r.headers.get('ETag')
+        if etag is None and isinstance(body, bytes):
+            etag = '"%s"' % hashlib.blake2b(body, digest_size=16).hexdigest()
+            r.headers['ETag'] = etag
+        last_modified = r.last_modified
+        if not_modified(request, etag, last_modified):
+            return not_modified_response(etag, last_modified)
+        return r
+    return conditional
+
+
+# 压缩放在 conditional_factory 外面：ETag 按未压缩的 body 计算，
+# 压缩后的表示和原来的字节不同，ETag 改成弱校验值 W/"..."，If-None-Match 仍然按弱比较命中
+# 304 没有 body，但要带上和压缩后的 200 相同的 ETag 和 Vary，否则缓存会用它更新已经保存的压缩表示
+
+
+async def compression_factory(app, handler):
+    async def compression(request):
+        r = await handler(request)
+        # 流式响应、静态文件（FileResponse）不在这里处理
+        if not isinstance(r, web.Response):
+            return r
+        if r.status == 304:
+            if 'Accept-Encoding' not in r.headers.getall('Vary', ()):
+                r.headers.add('Vary', 'Accept-Encoding')
+            if compress.negotiate(request.headers.get('Accept-Encoding', '')) is not None:
+                weaken_etag(r)
+            return r
+        body = r.body
+        if not isinstance(body, bytes) or len(body) < compress.MIN_SIZE:
+            return r
+        if 'Content-Encoding' in r.headers or not compress.compressible(r.content_type):
+            return r
+        r.headers.add('Vary', 'Accept-Encoding')
+        encoding = compress.negotiate(request.headers.get('Accept-Encoding', ''))
+        if encoding is None:
+            return r
+        if len(body) >= compress.EXECUTOR_SIZE:
+            body = await asyncio.get_running_loop().run_in_executor(None, compress.compress, body, encoding)
+        else:
+            body = compress.compress(body, encoding)
+        r.body = body
+        r.headers['Content-Encoding'] = encoding
+        return weaken_etag(r)
+    return compression
+
+
+# 每个路由的请求耗时和状态码，见 metrics.py
+# 以 route 对象为 key，不在请求中格式化字符串；放在压缩外面，耗时包括压缩
+
+
+async def metrics_factory(app, handler):
+    async def record(request):
+        start = time.perf_counter()
+        status = 500
+        try:
+            r = await handler(request)
+            status = r.status
+            return r
+        except web.HTTPException as e:
+            status = e.status
+            raise
+        finally:
+            metrics.observe_request(request.match_info.route, request.method, status, time.perf_counter() - start)
+    return record
+
+
 async def data_factory(app, handler):
     async def parse_data(request):
         if request.method == 'POST':
             if request.content_type.startswith('application/json'):
-                request.__data__ = await request.json()
+                request.__data__ = await request.json(loads=serializer.loads)
                 logging.info('request json: %s' % str(request.__data__))
             elif request.content_type.startswith('application/x-www-form-urlencoded'):
                 request.__data__ = await request.post()
@@ -66,9 +234,40 @@ async def data_factory(app, handler):
     return
 
 
+# 流式渲染模版：用 template.generate() 逐段渲染，攒够 chunk_size 就发出去
+# 没有 Content-Length，aiohttp 对 HTTP/1.1 自动使用 chunked 编码，HTTP/1.0 则发送完后关闭连接
+# 浏览器可以更早收到页面的开头，大页面（例如有几百条评论的博客）也不用整个放在内存中
+# resp.write 会等待发送缓冲区有空间，客户端接收得慢时渲染也会随之暂停（背压）
+# 注意：响应头在第一次 write 之前就发出去了，之后的中间件不能再修改它
+
+
+async def stream_template(request, template, context, chunk_size=16384, etag=None, last_modified=None):
+    resp = set_validators(web.StreamResponse(), etag, last_modified)
+    resp.content_type = 'text/html'
+    resp.charset = 'utf-8'
+    # 流式响应不经过 compression_factory，由 aiohttp 边发送边压缩（只支持 gzip）
+    resp.headers['Vary'] = 'Accept-Encoding'
+    if compress.negotiate(request.headers.get('Accept-Encoding', ''), ('gzip',)):
+        resp.enable_compression(web.ContentCoding.gzip)
+        weaken_etag(resp)
+    await resp.prepare(request)
+    buf = []
+    size = 0
+    for part in template.generate(**context):
+        buf.append(part)
+        size += len(part)
+        if size >= chunk_size:
+            await resp.write(''.join(buf).encode('utf-8'))
+            buf = []
+            size = 0
+    if buf:
+        await resp.write(''.join(buf).encode('utf-8'))
+    await resp.write_eof()
+    return resp
+
+
 async def response_factory(app, handler):
     async def response(request):
-        logging.info('Response handler...')
         # 用对应的函数处理request
         r = await handler(request)
         # isinstance(a,b)判断a是否是b这种类型
@@ -85,18 +284,28 @@ async def response_factory(app, handler):
             resp.content_type = 'text/html;charset=utf-8'
             return resp
         if isinstance(r, dict):
+            # handler 给出的校验值，在序列化之前比较
+            etag = r.pop('__etag__', None)
+            last_modified = r.pop('__last_modified__', None)
+            if etag is not None:
+                etag = quote_etag(etag)
+            if (etag is not None or last_modified is not None) and not_modified(request, etag, last_modified):
+                return not_modified_response(etag, last_modified)
             # 如果是字典，检查是否有模版，如果有，参数输入模版
             template = r.get('__template__')
             if template is None:
-                resp = web.Response(body=json.dumps(
-                    r, ensure_ascii=False, default=lambda o: o.__dict__).encode('utf-8'))
+                # 编码使用 serializer 选择的 JSON 库
+                resp = web.Response(body=serializer.dumps(r))
                 resp.content_type = 'application/json;charset=utf-8'
-                return resp
+            elif r.get('__stream__'):
+                # handler 返回 '__stream__': True 时边渲染边发送，校验值要在发送响应头之前设置
+                return await stream_template(request, app['__templating__'].get_template(template), r,
+                                             etag=etag, last_modified=last_modified)
             else:
                 resp = web.Response(body=app['__templating__'].get_template(
                     template).render(**r).encode('utf-8'))
                 resp.content_type = 'text/html;charset=utf-8'
-                return resp
+            return set_validators(resp, etag, last_modified)
         if isinstance(r, int) and r >= 100 and r < 600:
             return web.Response(text=r)
         if isinstance(r, tuple) and len(r) == 2:
@@ -123,27 +332,81 @@ def datetime_filter(t):
     dt = datetime.fromtimestamp(t)
     return u'%s年%s月%s日' % (dt.year, dt.month, dt.day)
 
-async def init(loop):
-    # 首先连接mySQL数据库
-    await orm.create_pool(loop=loop, host='localhost', port=3306, user='webapp', password='0506', db='awesome')
-    # 采用aiohttp库，启动一个web应用
+# 创建 web 应用，不连接数据库、不监听端口（bench.py 也用它）
+
+
+def create_app(configs):
+    # 采用aiohttp库，创建一个web应用
     # middlewars 拦截器，在URL被对应的函数处理之前，先对URL进行处理
     # logger_factory作用是做一个日志的记录
     # response_factory将url处理函数处理后的结果转换为web.Response对象
     # 即 type()=web.StreamResponse
-    app = web.Application(loop=loop, middlewares=[
-        logger_factory, response_factory
+    # TrieRouter: 路由表按哈希表 + 前缀树查找，见 router.py
+    # conditional_factory 计算 ETag，客户端缓存仍然有效时返回 304
+    # compression_factory 按 Accept-Encoding 压缩 HTML/JSON
+    # metrics_factory 记录每个路由的耗时，GET /metrics 查看
+    app = web.Application(router=TrieRouter(), middlewares=[
+        logger_factory, metrics_factory, compression_factory, conditional_factory, response_factory
     ])
     # 初始化jinja2模版
-    init_jinja2(app, filters=dict(datetime=datetime_filter))
+    # production=True 时不检查模版修改、使用字节码缓存并预先编译，见 init_jinja2
+    init_jinja2(app, filters=dict(datetime=datetime_filter), production=configs.web.production)
     # 批量注册handler文件内的url处理函数
     add_routes(app, 'handlers')
     # 增加状态码？这个不太懂
     add_static(app)
-    srv = await loop.create_server(app.make_handler(), '127.0.0.1', 9000)
-    logging.info('server started at http://127.0.0.1:9000...')
-    return srv
+    return app
+
+
+async def close_pool(app):
+    await orm.close_pool()
+
+
+async def init(configs, reuse_port=False, sock=None):
+    ' create the pool and the app, start listening and return the AppRunner. '
+    # 日志交给后台线程写出，见 applog.py
+    applog.setup(**configs.log)
+    # 首先连接mySQL数据库，参数来自 conf/config.py
+    await orm.create_pool(**configs.db)
+    app = create_app(configs)
+    # runner.cleanup() 时关闭连接池
+    app.on_cleanup.append(close_pool)
+    web_conf = configs.web
+    # AppRunner 负责启动和平滑关闭：cleanup() 停止监听，
+    # 等待处理中的请求（最多 shutdown_timeout 秒），关闭空闲连接，然后执行 on_shutdown / on_cleanup
+    runner = web.AppRunner(app, shutdown_timeout=web_conf.shutdown_timeout)
+    await runner.setup()
+    # 多进程运行时（见 launcher.py），每个进程用 reuse_port 绑定同一个端口，由内核分配连接；
+    # 或者使用主进程创建好的 sock
+    if sock is not None:
+        site = web.SockSite(runner, sock)
+    else:
+        site = web.TCPSite(runner, web_conf.host, web_conf.port, reuse_port=reuse_port or None)
+    await site.start()
+    logging.info('server started at %s...' % site.name)
+    return runner
+
+
+def new_event_loop(use_uvloop=False):
+    ' create the event loop, uvloop when requested and installed. '
+    if use_uvloop:
+        try:
+            import uvloop
+        except ImportError:
+            logging.warning('uvloop is not installed, use the default asyncio loop')
+        else:
+            return uvloop.new_event_loop()
+    return asyncio.new_event_loop()
+
 
-loop = asyncio.get_event_loop()
-loop.run_until_complete(init(loop))
-loop.run_forever()
+if __name__ == '__main__':
+    loop = new_event_loop(configs.web.uvloop)
+    asyncio.set_event_loop(loop)
+    runner = loop.run_until_complete(init(configs))
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        loop.run_until_complete(runner.cleanup())
+        loop.close()
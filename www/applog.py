@@ -0,0 +1,106 @@
+# -*- encoding: utf-8 -*-
+'''
+@File    :   applog.py
+@Time    :   2026/10/18 21:40:05
+'''
+
+# here put the import lib
+# 日志：事件循环线程中的 logging 调用只把 LogRecord 放进队列（QueueHandler），
+# 由 QueueListener 的后台线程格式化成 JSON（一行一条）并写到 stderr，写日志不再阻塞事件循环
+# SQL 日志写到 'orm.sql' 这个 logger，按 sql_sample_rate 抽样（0.01 表示保留 1%）
+# 配置见 conf/config_default.py 的 log 部分，app.init 中调用 setup(**configs.log)
+# 注意：多进程运行时，后台线程不会随 fork 复制，每个工作进程要各自调用 setup
+
+import sys
+import json
+import queue
+import random
+import atexit
+import logging
+import logging.handlers
+
+# LogRecord 自带的属性，其余的属性（logging.info(..., extra=dict(...)) 传入的）原样输出到 JSON
+_RESERVED = frozenset(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | frozenset(['message', 'asctime'])
+
+
+class JSONFormatter(logging.Formatter):
+
+    def format(self, record):
+        d = dict(time=record.created, level=record.levelname, logger=record.name, message=record.getMessage())
+        for k, v in record.__dict__.items():
+            if k not in _RESERVED:
+                d[k] = v
+        if record.exc_info:
+            d['exc'] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            d['exc'] = record.exc_text
+        return json.dumps(d, ensure_ascii=False, default=str)
+
+
+class SampleFilter(logging.Filter):
+    '''
+    keep a random fraction of the records, rate between 0 and 1.
+    '''
+
+    def __init__(self, rate):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record):
+        return random.random() < self.rate
+
+
+class QueueHandler(logging.handlers.QueueHandler):
+    '''
+    enqueue records as they are, leaving the message formatting to the listener thread.
+    '''
+
+    def prepare(self, record):
+        # 标准库的 QueueHandler 在这里就格式化消息；这里推迟到后台线程，
+        # 所以传给 logging 的参数在记录之后不能再修改
+        if record.exc_info:
+            # traceback 引用着栈帧，先在当前线程转成字符串
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+_listener = None
+
+
+def setup(level='INFO', json_format=True, sql_sample_rate=1.0, stream=None):
+    ' route all logging through a queue drained by a background thread. '
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+    handler = logging.StreamHandler(stream or sys.stderr)
+    if json_format:
+        handler.setFormatter(JSONFormatter())
+    else:
+        handler.setFormatter(logging.Formatter('%(levelname)s:%(name)s:%(message)s'))
+    q = queue.SimpleQueue()
+    root = logging.getLogger()
+    root.handlers[:] = [QueueHandler(q)]
+    root.setLevel(level)
+    sql = logging.getLogger('orm.sql')
+    sql.filters[:] = []
+    if sql_sample_rate <= 0:
+        sql.disabled = True
+    else:
+        sql.disabled = False
+        if sql_sample_rate < 1:
+            sql.addFilter(SampleFilter(sql_sample_rate))
+    _listener = logging.handlers.QueueListener(q, handler)
+    _listener.start()
+    return _listener
+
+
+def shutdown():
+    ' flush the queued records and stop the background thread. '
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+atexit.register(shutdown)
@@ -0,0 +1,78 @@
+# -*- encoding: utf-8 -*-
+'''
+@File    :   assets.py
+@Time    :   2026/10/18 15:27:12
+'''
+
+# here put the import lib
+# 静态文件指纹：启动时计算 static 下每个文件内容的哈希，生成带指纹的文件名
+#     css/uikit.min.css => css/uikit.min.3f2a9c1b.css
+# 模版中写 {{ static_url('css/uikit.min.css') }} 或 {{ 'css/uikit.min.css' | static_url }}
+# 文件内容变了指纹就变，所以带指纹的 URL 可以让浏览器永久缓存（immutable），回访时不再请求静态文件
+# 不带指纹的 URL 仍然可以访问，但不设置长期缓存
+# 压缩好的 .gz/.br 文件不进入清单，由 aiohttp 的 FileResponse 根据 Accept-Encoding 选择
+
+import os
+import hashlib
+import logging
+from aiohttp import web
+logging.basicConfig(level=logging.INFO)
+
+# 指纹的长度（十六进制字符数）
+DIGEST_SIZE = 8
+
+IMMUTABLE = 'public, max-age=31536000, immutable'
+
+
+def fingerprint(filename, digest):
+    ' insert the digest before the last extension: uikit.min.js => uikit.min.<digest>.js '
+    base, ext = os.path.splitext(filename)
+    return '%s.%s%s' % (base, digest, ext)
+
+
+class AssetManifest(object):
+    '''
+    content hashes of the files under a static directory, and the handler serving them.
+    '''
+
+    def __init__(self, root, prefix='/static/'):
+        self.root = root
+        self.prefix = prefix
+        # 原文件名 => 带指纹的文件名
+        self.urls = dict()
+        # 带指纹的文件名 => 原文件名
+        self.files = dict()
+
+    def build(self):
+        urls = dict()
+        for dirpath, _, filenames in os.walk(self.root):
+            for filename in filenames:
+                if filename.endswith('.gz') or filename.endswith('.br') or filename.endswith('.tmp'):
+                    continue
+                path = os.path.join(dirpath, filename)
+                h = hashlib.blake2b(digest_size=DIGEST_SIZE // 2)
+                with open(path, 'rb') as f:
+                    for block in iter(lambda: f.read(65536), b''):
+                        h.update(block)
+                # URL 中统一使用 /
+                name = os.path.relpath(path, self.root).replace(os.sep, '/')
+                urls[name] = fingerprint(name, h.hexdigest())
+        self.urls = urls
+        self.files = dict((v, k) for k, v in urls.items())
+        logging.info('asset manifest: %s files under %s' % (len(urls), self.root))
+        return self
+
+    def url(self, name):
+        ' return the fingerprinted url of a static file, or the plain url if it is unknown. '
+        name = name.lstrip('/')
+        return self.prefix + self.urls.get(name, name)
+
+    async def handle(self, request):
+        filename = request.match_info['filename']
+        name = self.files.get(filename)
+        if name is not None:
+            return web.FileResponse(os.path.join(self.root, name), headers={'Cache-Control': IMMUTABLE})
+        # 只发送清单中的文件，不会访问到 static 目录以外
+        if filename in self.urls:
+            return web.FileResponse(os.path.join(self.root, filename))
+        raise web.HTTPNotFound()
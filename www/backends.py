@@ -0,0 +1,199 @@
+# -*- encoding: utf-8 -*-
+'''
+@File    :   backends.py
+@Time    :   2026/10/19 17:36:52
+'''
+
+# here put the import lib
+# 数据库驱动，db 配置中的 backend 选择：
+#     'mysql'   aiomysql，默认
+#     'sqlite'  aiosqlite，database 是文件路径，':memory:' 表示临时数据库（close 时删除）；不需要 mysql 服务器，用于本地测试和性能测试
+# orm 中的语句统一使用 mysql 的 %s 占位符和反引号，sqlite 也认识反引号、limit m, n 和多行 insert，
+# 所以 sqlite 只需要把 %s 换成 ?（转换结果缓存起来）
+# 驱动返回的连接要和 aiomysql 的一样使用：
+#     cur = await conn.cursor(backend.dict_cursor); await cur.execute(sql, args); await cur.fetchall() ...
+#     await conn.begin() / commit() / rollback()；连接池还需要 ping()、close() 和 closed，见 pool.py
+
+import os
+import sqlite3
+import tempfile
+import contextlib
+import functools
+import logging
+logging.basicConfig(level=logging.INFO)
+
+try:
+    import aiomysql
+except ImportError:
+    aiomysql = None
+
+try:
+    import aiosqlite
+except ImportError:
+    aiosqlite = None
+
+
+class Backend(object):
+    '''
+    interface of database drivers. connector(kw) returns a coroutine function opening one connection.
+    '''
+
+    # conn.cursor() 的参数：返回字典的游标、流式读取的游标
+    dict_cursor = None
+    stream_cursor = None
+
+    def connector(self, kw):
+        raise NotImplementedError
+
+    async def close(self):
+        pass
+
+
+class MySQLBackend(Backend):
+
+    def __init__(self):
+        if aiomysql is None:
+            raise RuntimeError('aiomysql is not installed')
+        self.dict_cursor = aiomysql.DictCursor
+        # 服务端游标，数据在 fetch 时才从mysql传过来
+        self.stream_cursor = aiomysql.SSDictCursor
+
+    def connector(self, kw):
+        return functools.partial(
+            aiomysql.connect,
+            host=kw.get('host', 'localhost'),
+            port=kw.get('port', 3306),
+            user=kw['user'],
+            password=kw['password'],
+            # db参数为要连接使用的数据库database，配置文件中叫 database
+            db=kw['db'] if 'db' in kw else kw['database'],
+            charset=kw.get('charset', 'utf8'),
+            autocommit=kw.get('autocommit', True)
+        )
+
+
+# sqlite 的游标类型，只用来区分是否返回字典
+DICT = 'dict'
+
+
+@functools.lru_cache(maxsize=1024)
+def _sqlite_sql(sql):
+    # %% 是 mysql 语句中的 % 字面量
+    return sql.replace('%s', '?').replace('%%', '%')
+
+
+class SQLiteCursor(object):
+
+    def __init__(self, conn, as_dict):
+        self._conn = conn
+        self._as_dict = as_dict
+        self._cur = None
+        self.rowcount = -1
+
+    async def execute(self, sql, args=()):
+        self._cur = await self._conn.raw.execute(_sqlite_sql(sql), tuple(args or ()))
+        self.rowcount = self._cur.rowcount
+
+    async def executemany(self, sql, args_list):
+        self._cur = await self._conn.raw.executemany(_sqlite_sql(sql), args_list)
+        self.rowcount = self._cur.rowcount
+
+    def _rows(self, rs):
+        if not self._as_dict:
+            return rs
+        names = [d[0] for d in self._cur.description]
+        return [dict(zip(names, r)) for r in rs]
+
+    async def fetchall(self):
+        return self._rows(await self._cur.fetchall())
+
+    async def fetchmany(self, size):
+        return self._rows(await self._cur.fetchmany(size))
+
+    async def close(self):
+        if self._cur is not None:
+            await self._cur.close()
+
+
+class SQLiteConnection(object):
+    '''
+    an aiosqlite connection with the subset of the aiomysql connection api used by orm and pool.
+    '''
+
+    def __init__(self, raw):
+        self.raw = raw
+        self.closed = False
+
+    async def cursor(self, cursor_class=None):
+        return SQLiteCursor(self, cursor_class == DICT)
+
+    async def begin(self):
+        await self.raw.execute('begin')
+
+    async def commit(self):
+        await self.raw.execute('commit')
+
+    async def rollback(self):
+        await self.raw.execute('rollback')
+
+    async def ping(self):
+        await self.raw.execute('select 1')
+
+    def close(self):
+        self.closed = True
+        return self.raw.close()
+
+
+class SQLiteBackend(Backend):
+
+    dict_cursor = DICT
+    stream_cursor = DICT
+
+    def __init__(self):
+        if aiosqlite is None:
+            raise RuntimeError('aiosqlite is not installed')
+        # ':memory:' 创建的临时数据库文件，close() 时删除
+        self._temp = []
+
+    def connector(self, kw):
+        database = kw.get('database', ':memory:')
+        if database == ':memory:':
+            # 连接池中的多个连接要看到同一个数据库。共享缓存的内存数据库使用表锁，
+            # 另一个连接在事务中写过的表，读写都立即报 database table is locked，不会等待 busy_timeout，
+            # 所以改用临时文件加 WAL，和文件数据库的并发行为一致
+            fd, path = tempfile.mkstemp(prefix='awesome-', suffix='.db')
+            os.close(fd)
+            self._temp.append(path)
+            database = path
+        if not database.startswith('file:'):
+            database = 'file:%s' % os.path.abspath(database)
+        timeout = kw.get('busy_timeout', 5)
+        # WAL：读不阻塞写，写等待 busy_timeout。日志模式保存在数据库文件中，这里设置一次，
+        # warm_up 并发打开的连接各自切换日志模式会互相冲突（database is locked）
+        with contextlib.closing(sqlite3.connect(database, uri=True, timeout=timeout)) as conn:
+            conn.execute('pragma journal_mode=wal')
+
+        async def connect():
+            # isolation_level=None：自动提交，和 aiomysql 的 autocommit=True 一致，事务由 begin() 开始
+            raw = await aiosqlite.connect(database, uri=True, isolation_level=None, timeout=timeout)
+            return SQLiteConnection(raw)
+        return connect
+
+    async def close(self):
+        temp, self._temp = self._temp, []
+        for path in temp:
+            for name in (path, path + '-wal', path + '-shm'):
+                try:
+                    os.remove(name)
+                except FileNotFoundError:
+                    pass
+
+
+BACKENDS = dict(mysql=MySQLBackend, sqlite=SQLiteBackend)
+
+
+def get_backend(name):
+    ' create the backend registered under name. '
+    if name not in BACKENDS:
+        raise ValueError('Unknown database backend: %s' % name)
+    return BACKENDS[name]()
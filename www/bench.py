@@ -0,0 +1,435 @@
+# -*- encoding: utf-8 -*-
+'''
+@File    :   bench.py
+@Time    :   2026/10/17 14:05:12
+'''
+
+# here put the import lib
+# 性能测试脚本，不需要连接数据库
+# 用法：python bench.py           运行全部测试
+#       python bench.py rows      只运行指定的测试
+import sys
+import time
+import asyncio
+import logging
+import tracemalloc
+import warnings
+import orm
+import serializer
+from aiohttp import web
+from aiohttp.test_utils import make_mocked_request
+from coroweb import RequestHandler
+from router import TrieRouter
+from model import User, Blog, Comment, next_id
+
+BENCHES = dict()
+
+
+def bench(name):
+    ' register a benchmark under name. '
+    def decorator(func):
+        BENCHES[name] = func
+        return func
+    return decorator
+
+
+def sample_row(model, i):
+    # 按列的类型构造一行假数据
+    r = dict()
+    for k, f in model.__mappings__.items():
+        if f.primary_key:
+            r[k] = next_id()
+        elif f.column_type == 'real':
+            r[k] = time.time()
+        elif f.column_type == 'boolean':
+            r[k] = False
+        elif f.column_type == 'text':
+            r[k] = 'content %s ' % i * 20
+        else:
+            r[k] = '%s-%s' % (k, i)
+    return r
+
+# Model（dict 子类）和紧凑的 Row（__slots__）对比：
+# 每行占用的内存、构造时间、读取全部列的时间
+
+
+@bench('rows')
+def bench_rows(n=10000):
+    for model in (User, Blog, Comment):
+        rows = [sample_row(model, i) for i in range(n)]
+        columns = [model.__primary_key__] + model.__fields__
+        for label, make in (('Model', model), ('Row', model.__row__)):
+            tracemalloc.start()
+            objs = [make(**r) for r in rows]
+            size, _ = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            del objs
+            start = time.perf_counter()
+            objs = [make(**r) for r in rows]
+            build = time.perf_counter() - start
+            start = time.perf_counter()
+            for o in objs:
+                for c in columns:
+                    getattr(o, c)
+            access = time.perf_counter() - start
+            print('%-8s %-6s %8.1f bytes/row  build %6.3f us/row  access %6.3f us/row' % (
+                model.__name__, label, size / n, build * 1e6 / n, access * 1e6 / n))
+
+
+# RequestHandler 参数绑定：不同签名的 handler 每秒能处理的请求数
+# 用一个只实现了 RequestHandler 用到的属性的假 request，不经过 aiohttp 的网络部分
+
+
+class FakeRequest(object):
+
+    def __init__(self, method='GET', query_string='', match_info=None, json=None):
+        self.method = method
+        self.query_string = query_string
+        self.match_info = match_info or dict()
+        self.content_type = 'application/json' if json is not None else ''
+        self._json = json
+
+    async def json(self, loads=None):
+        return self._json
+
+    async def post(self):
+        return dict()
+
+
+async def h_none():
+    return 'ok'
+
+
+async def h_path(id):
+    return id
+
+
+async def h_query(*, page='1', cursor=None):
+    return page
+
+
+async def h_json(*, name, summary, content):
+    return name
+
+
+@bench('handlers')
+def bench_handlers(n=100000):
+    cases = [
+        ('no args', h_none, FakeRequest()),
+        ('path args', h_path, FakeRequest(match_info=dict(id='001'))),
+        ('query args', h_query, FakeRequest(query_string='page=2')),
+        ('json body', h_json, FakeRequest('POST', json=dict(name='n', summary='s', content='c'))),
+    ]
+    # 只测绑定参数本身的开销，关闭 INFO 日志
+    logging.disable(logging.INFO)
+
+    async def run(handler, request):
+        best = None
+        # 取 5 轮中最快的一轮，减少抖动
+        for _ in range(5):
+            start = time.perf_counter()
+            for _ in range(n):
+                await handler(request)
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        return best
+    try:
+        for label, fn, request in cases:
+            elapsed = asyncio.run(run(RequestHandler(None, fn), request))
+            print('%-12s %10.0f req/s' % (label, n / elapsed))
+    finally:
+        logging.disable(logging.NOTSET)
+
+
+# 路由查找：路由数量从 10 增加到 1000 时，每次查找的耗时
+# 一半是静态路由，一半是共享前缀 /api/blogs/{id}/ 的动态路由，查找最后注册的那条
+
+
+async def h_route(request):
+    return web.Response()
+
+
+@bench('router')
+def bench_router(n=20000):
+    async def run(router, request):
+        start = time.perf_counter()
+        for _ in range(n):
+            await router.resolve(request)
+        return time.perf_counter() - start
+
+    # TrieRouter 通过已经不推荐的 router 参数传入 web.Application
+    warnings.simplefilter('ignore', DeprecationWarning)
+    for count in (10, 100, 1000):
+        line = []
+        for label, router in (('UrlDispatcher', web.UrlDispatcher()), ('TrieRouter', TrieRouter())):
+            web.Application(router=router)
+            for i in range(count // 2):
+                router.add_route('GET', '/api/static%s' % i, h_route)
+                router.add_route('GET', '/api/blogs/{id}/action%s' % i, h_route)
+            for path in ('/api/static%s' % (count // 2 - 1), '/api/blogs/001/action%s' % (count // 2 - 1)):
+                elapsed = asyncio.run(run(router, make_mocked_request('GET', path)))
+                line.append('%s %s %6.2f us' % (label, 'static ' if 'static' in path else 'dynamic', elapsed * 1e6 / n))
+        print('%5s routes: %s' % (count, ', '.join(line)))
+
+
+# JSON 编码：findAll 返回 1k/10k 行时，各个已安装的 JSON 库编码 Model 和 Row 列表的耗时
+
+
+@bench('json')
+def bench_json(repeat=5):
+    for n in (1000, 10000):
+        rows = [sample_row(Comment, i) for i in range(n)]
+        for label, make in (('Model', Comment), ('Row', Comment.__row__)):
+            payload = dict(comments=[make(**r) for r in rows])
+            for name, (dumps, loads) in serializer.BACKENDS.items():
+                best = None
+                for _ in range(repeat):
+                    start = time.perf_counter()
+                    body = dumps(payload)
+                    elapsed = time.perf_counter() - start
+                    best = elapsed if best is None else min(best, elapsed)
+                start = time.perf_counter()
+                loads(body)
+                decode = time.perf_counter() - start
+                print('%6s rows %-6s %-7s encode %8.2f ms  decode %8.2f ms  %8s bytes' % (
+                    n, label, name, best * 1e3, decode * 1e3, len(body)))
+
+
+# 事件循环：默认的 asyncio 循环和 uvloop（已安装时）对比
+# 启动时间（创建 app、注册路由、开始监听）和首页（index handler）的吞吐量
+# 请求经过完整的中间件和真实的 TCP 连接，ORM 的查询换成返回固定数据，不需要数据库
+
+
+async def _get(port, n):
+    # 一个 keep-alive 连接上顺序发送 n 个请求
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    request = b'GET / HTTP/1.1\r\nHost: bench\r\n\r\n'
+    for _ in range(n):
+        writer.write(request)
+        head = await reader.readuntil(b'\r\n\r\n')
+        length = 0
+        for line in head.split(b'\r\n'):
+            if line.lower().startswith(b'content-length:'):
+                length = int(line[15:])
+        await reader.readexactly(length)
+    writer.close()
+
+
+async def _start(app):
+    runner = web.AppRunner(app.create_app(app.configs))
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    return runner
+
+
+async def _throughput(port, n, concurrency):
+    start = time.perf_counter()
+    await asyncio.gather(*[_get(port, n // concurrency) for _ in range(concurrency)])
+    return time.perf_counter() - start
+
+
+def _fake_select(rows):
+    # 和 orm._select 一样记录 SQL 日志，但不访问数据库
+    async def select(sql, args, size=None):
+        orm._sql_log.info('SQL: %s, args: %s', sql, args)
+        return rows
+    return select
+
+
+@bench('loops')
+def bench_loops(n=5000, concurrency=20):
+    import app
+    select, orm._select = orm._select, _fake_select([sample_row(User, i) for i in range(20)])
+    logging.disable(logging.INFO)
+    try:
+        for label, use_uvloop in (('asyncio', False), ('uvloop', True)):
+            if use_uvloop:
+                try:
+                    import uvloop
+                except ImportError:
+                    print('uvloop     not installed, skipped')
+                    continue
+            loop = app.new_event_loop(use_uvloop)
+            asyncio.set_event_loop(loop)
+            begin = time.perf_counter()
+            runner = loop.run_until_complete(_start(app))
+            startup = time.perf_counter() - begin
+            port = runner.addresses[0][1]
+            # 预热一轮再计时
+            loop.run_until_complete(_throughput(port, n, concurrency))
+            elapsed = loop.run_until_complete(_throughput(port, n, concurrency))
+            loop.run_until_complete(runner.cleanup())
+            loop.close()
+            print('%-10s startup %7.1f ms  index %8.0f req/s' % (label, startup * 1e3, n / elapsed))
+    finally:
+        orm._select = select
+        asyncio.set_event_loop(None)
+        logging.disable(logging.NOTSET)
+
+
+# 日志：首页的吞吐量，每个请求有 Request、aiohttp 访问日志和 SQL 各一条日志
+#     off       关闭日志
+#     sync      标准库默认的做法，在事件循环线程中格式化并写出
+#     queue     applog：放进队列，由后台线程格式化成 JSON 写出
+#     sampled   applog，SQL 日志只保留 1%（config_default 的默认值）
+# 输出分别写到 /dev/null 和一个每次写入阻塞 0.2 ms 的流（模拟磁盘或管道写满时的停顿）
+
+
+class SlowStream(object):
+
+    def __init__(self, stream, delay=0.0002):
+        self.stream = stream
+        self.delay = delay
+
+    def write(self, s):
+        time.sleep(self.delay)
+        return self.stream.write(s)
+
+    def flush(self):
+        self.stream.flush()
+
+
+@bench('logging')
+def bench_logging(n=5000, concurrency=20):
+    import os
+    import app
+    import applog
+    select, orm._select = orm._select, _fake_select([sample_row(User, i) for i in range(20)])
+    root = logging.getLogger()
+    handlers, level = root.handlers[:], root.level
+    devnull = open(os.devnull, 'w')
+    try:
+        for sink, stream in (('devnull', devnull), ('slow', SlowStream(devnull))):
+            for label in ('off', 'sync', 'queue', 'sampled'):
+                applog.shutdown()
+                if label == 'off':
+                    logging.disable(logging.CRITICAL)
+                elif label == 'sync':
+                    handler = logging.StreamHandler(stream)
+                    handler.setFormatter(logging.Formatter('%(levelname)s:%(name)s:%(message)s'))
+                    root.handlers[:] = [handler]
+                    root.setLevel(logging.INFO)
+                    logging.getLogger('orm.sql').filters[:] = []
+                else:
+                    applog.setup('INFO', True, 1.0 if label == 'queue' else 0.01, stream)
+                loop = asyncio.new_event_loop()
+                asyncio.set_event_loop(loop)
+                runner = loop.run_until_complete(_start(app))
+                port = runner.addresses[0][1]
+                loop.run_until_complete(_throughput(port, n, concurrency))
+                elapsed = loop.run_until_complete(_throughput(port, n, concurrency))
+                loop.run_until_complete(runner.cleanup())
+                loop.close()
+                logging.disable(logging.NOTSET)
+                print('%-8s %-10s index %8.0f req/s' % (sink, label, n / elapsed))
+    finally:
+        orm._select = select
+        applog.shutdown()
+        asyncio.set_event_loop(None)
+        root.handlers[:] = handlers
+        root.setLevel(level)
+        logging.getLogger('orm.sql').filters[:] = []
+        devnull.close()
+
+
+# ORM 端到端：sqlite 临时数据库（db 配置的 backend='sqlite'，见 backends.py），不需要 mysql
+# 语句经过完整的 Model -> orm -> 连接池 -> 驱动，每项输出平均耗时和每秒的行数（或次数）：
+#     save        逐行 save()
+#     save_all    批量插入（每批 __batch_size__ 行一条 insert）
+#     find        按主键查询
+#     findAll     按 blog_id 查询一篇博客的全部评论
+#     findPage    按 created_at 逐页读完整张表
+#     update_all  批量更新全部行
+#     iterate     流式读取整张表
+#     find x20    20 个并发的 find，连接池 maxsize=10
+# 用 python bench.py orm 运行；database 可以换成文件路径，测试带磁盘写入的情况
+
+
+async def _timed(label, count, fn):
+    start = time.perf_counter()
+    await fn()
+    elapsed = time.perf_counter() - start
+    print('%-12s %7d  %9.1f us/op  %10.0f ops/s' % (label, count, elapsed / count * 1e6, count / elapsed))
+
+
+async def _bench_orm(n, database):
+    await orm.create_pool(backend='sqlite', database=database, minsize=10, maxsize=10)
+    try:
+        await orm.execute(orm.create_table_sql(Comment), [])
+        await orm.execute('create index if not exists `idx_blog_id` on `comments` (`blog_id`)', [])
+        await orm.execute('create index if not exists `idx_created_at` on `comments` (`created_at`)', [])
+        blog_ids = [next_id() for _ in range(max(n // 50, 1))]
+        rows = []
+        for i in range(n):
+            r = sample_row(Comment, i)
+            r['blog_id'] = blog_ids[i % len(blog_ids)]
+            rows.append(r)
+        k = n // 10
+
+        async def save():
+            for r in rows[:k]:
+                await Comment(**r).save()
+        await _timed('save', k, save)
+
+        async def save_all():
+            await Comment.save_all(rows[k:])
+        await _timed('save_all', n - k, save_all)
+
+        ids = [r['id'] for r in rows]
+        picks = [ids[(i * 7919) % n] for i in range(min(n, 2000))]
+
+        async def find():
+            for pk in picks:
+                await Comment.find(pk)
+        await _timed('find', len(picks), find)
+
+        async def find_all():
+            for blog_id in blog_ids:
+                await Comment.findAll('blog_id=?', [blog_id])
+        await _timed('findAll', len(blog_ids), find_all)
+
+        async def find_page():
+            cursor = None
+            while True:
+                _, cursor = await Comment.findPage(limit=50, cursor=cursor)
+                if cursor is None:
+                    break
+        await _timed('findPage', n, find_page)
+
+        models = await Comment.findAll()
+        for m in models:
+            m.content = 'updated'
+
+        async def update_all():
+            await Comment.update_all(models)
+        await _timed('update_all', n, update_all)
+
+        async def iterate():
+            async for _ in Comment.iterate():
+                pass
+        await _timed('iterate', n, iterate)
+
+        async def find_concurrent():
+            async def worker(i):
+                for pk in picks[i::20]:
+                    await Comment.find(pk)
+            await asyncio.gather(*[worker(i) for i in range(20)])
+        await _timed('find x20', len(picks), find_concurrent)
+    finally:
+        await orm.close_pool()
+
+
+@bench('orm')
+def bench_orm(n=10000, database=':memory:'):
+    logging.disable(logging.INFO)
+    try:
+        asyncio.run(_bench_orm(n, database))
+    finally:
+        logging.disable(logging.NOTSET)
+
+
+if __name__ == '__main__':
+    for name in sys.argv[1:] or list(BENCHES):
+        print('== %s' % name)
+        BENCHES[name]()
@@ -0,0 +1,63 @@
+# -*- encoding: utf-8 -*-
+'''
+@File    :   cache.py
+@Time    :   2026/10/17 10:12:31
+'''
+
+# here put the import lib
+# 缓存后端，目前用于 orm 的查询结果缓存
+# 条目按 namespace 分组（orm 中就是表名），invalidate(namespace) 使整组失效
+# 接口都是协程，以后换成 redis 这类共享缓存时调用方不用改
+
+import time
+from collections import OrderedDict
+
+
+class CacheBackend(object):
+    '''
+    interface of cache backends. get returns None when the key is missing or expired.
+    '''
+
+    async def get(self, namespace, key):
+        raise NotImplementedError
+
+    async def set(self, namespace, key, value, ttl):
+        raise NotImplementedError
+
+    async def invalidate(self, namespace):
+        raise NotImplementedError
+
+
+class MemoryCache(CacheBackend):
+    '''
+    in-process LRU cache with per-entry ttl, bounded by maxsize entries.
+    '''
+
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        # 每个 namespace 的版本号，invalidate 时加一
+        # 旧版本的条目不用逐个删除，下次读到时发现版本不对就丢弃，最终被 LRU 挤出去
+        self._versions = dict()
+
+    async def get(self, namespace, key):
+        k = (namespace, key)
+        entry = self._data.get(k)
+        if entry is None:
+            return None
+        value, expires, version = entry
+        if expires < time.monotonic() or version != self._versions.get(namespace, 0):
+            del self._data[k]
+            return None
+        self._data.move_to_end(k)
+        return value
+
+    async def set(self, namespace, key, value, ttl):
+        k = (namespace, key)
+        self._data[k] = (value, time.monotonic() + ttl, self._versions.get(namespace, 0))
+        self._data.move_to_end(k)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    async def invalidate(self, namespace):
+        self._versions[namespace] = self._versions.get(namespace, 0) + 1
@@ -0,0 +1,118 @@
+# -*- encoding: utf-8 -*-
+'''
+@File    :   compress.py
+@Time    :   2026/10/18 14:06:40
+'''
+
+# here put the import lib
+# 响应压缩：gzip，安装了 brotli 时优先使用 br
+# 1. 动态响应（HTML/JSON）由 app.py 的 compression_factory 按 Accept-Encoding 协商后压缩
+#    太小的 body 压缩后省不了多少，不压缩；超过 EXECUTOR_SIZE 的 body 放到线程池中压缩，不阻塞事件循环
+# 2. 静态文件在启动时（或手动运行 python compress.py）预先生成 .gz/.br 文件，用最高压缩率，只压缩一次
+#    aiohttp 的静态文件响应会根据 Accept-Encoding 直接发送这些文件
+
+import os
+import sys
+import gzip
+import logging
+import functools
+logging.basicConfig(level=logging.INFO)
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# 小于这个大小的 body 不压缩
+MIN_SIZE = 1024
+# 大于这个大小的 body 在线程池中压缩
+EXECUTOR_SIZE = 64 * 1024
+
+# 只压缩文本类型，图片、压缩包本身已经压缩过
+CONTENT_TYPES = frozenset([
+    'text/html', 'text/css', 'text/plain', 'text/javascript', 'application/javascript',
+    'application/json', 'application/xml', 'image/svg+xml'
+])
+STATIC_EXTENSIONS = frozenset(['.html', '.css', '.js', '.json', '.svg', '.txt', '.xml'])
+
+# 按优先顺序排列
+ENCODINGS = ('br', 'gzip') if brotli is not None else ('gzip',)
+
+
+def compressible(content_type):
+    return content_type in CONTENT_TYPES
+
+
+@functools.lru_cache(maxsize=256)
+def negotiate(accept_encoding, encodings=ENCODINGS):
+    ' pick the preferred encoding allowed by an Accept-Encoding header, None for identity. '
+    # 浏览器发送的 Accept-Encoding 只有几种，解析结果缓存起来
+    qualities = dict()
+    for item in accept_encoding.lower().split(','):
+        name, _, params = item.partition(';')
+        name = name.strip()
+        q = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        qualities[name] = q
+    best = None
+    best_q = 0.0
+    for encoding in encodings:
+        q = qualities.get(encoding, qualities.get('*', 0.0))
+        if q > best_q:
+            best, best_q = encoding, q
+    return best
+
+
+def compress(body, encoding):
+    ' compress a response body with a level tuned for speed. '
+    if encoding == 'br':
+        return brotli.compress(body, quality=4)
+    return gzip.compress(body, compresslevel=6)
+
+
+def _write(path, data):
+    # 先写临时文件再改名，多个进程同时启动时也不会读到写了一半的文件
+    tmp = '%s.%s.tmp' % (path, os.getpid())
+    with open(tmp, 'wb') as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+
+def precompress(root, min_size=MIN_SIZE):
+    ' write .gz/.br siblings for the static files under root, skipping the up-to-date ones. '
+    count = 0
+    for dirpath, _, filenames in os.walk(root):
+        for filename in filenames:
+            if os.path.splitext(filename)[1] not in STATIC_EXTENSIONS:
+                continue
+            path = os.path.join(dirpath, filename)
+            st = os.stat(path)
+            if st.st_size < min_size:
+                continue
+            data = None
+            for encoding, ext in (('gzip', '.gz'), ('br', '.br')):
+                if encoding not in ENCODINGS:
+                    continue
+                target = path + ext
+                if os.path.exists(target) and os.stat(target).st_mtime >= st.st_mtime:
+                    continue
+                if data is None:
+                    with open(path, 'rb') as f:
+                        data = f.read()
+                if encoding == 'br':
+                    _write(target, brotli.compress(data, quality=11))
+                else:
+                    _write(target, gzip.compress(data, compresslevel=9, mtime=0))
+                count += 1
+    logging.info('precompressed %s static files under %s' % (count, root))
+    return count
+
+
+if __name__ == '__main__':
+    precompress(sys.argv[1] if len(sys.argv) > 1 else os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), 'static'))
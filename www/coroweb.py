@@ -11,6 +11,10 @@ from aiohttp import web
 import logging, functools, os, inspect, asyncio
 from urllib import parse
 from apis import APIError
+import serializer
+from compress import precompress
+from assets import AssetManifest
+from orm import decode_cursor, identity_map, db_session, CursorError, PoolTimeout
 logging.basicConfig(level=logging.INFO)
 
 # 编写一个web框架
@@ -123,93 +127,154 @@ class RequestHandler(object):
         self._has_named_kw_args = has_named_kw_args(fn)
         self._named_kw_args = get_named_kw_args(fn)
         self._required_kw_args = get_required_kw_args(fn)
+        # 注册时根据 handler 的签名生成参数绑定函数，每个请求只做这个 handler 需要的工作
+        # 没有关键字参数的 handler 不需要读取 POST 的 body
+        self._parse_body = bool(self._has_var_kw_arg or self._has_named_kw_args or self._required_kw_args)
+        self._bind = self._make_binder()
 
-    async def __call__(self, request):
-        # 用于当 print(函数)时，要输出的东西
-        kw = None
-        # self._has_var_kw_arg = True 说明有**kwargs这个参数
-        # _has_named_kw_args = True 说明 有关键字参数 例如 type='xx'
-        # _required_kw_args = True 说明 有request参数
-        if self._has_var_kw_arg or self._has_named_kw_args or self._required_kw_args:
-            # request 主要见https://docs.aiohttp.org/en/stable/web_reference.html
-            if request.method == 'POST':
-                # 判断是否header中带有content-type
-                # content-type主要是告诉服务器，接下来reqeust的内容格式是什么
-                # https://juejin.cn/post/6868277123824975886
-                # https://blog.csdn.net/woaixiaoyu520/article/details/76690686
-                # application/json 对应用request.json()方法
-                # application/x-www-form-urlencoded 对应用request.post()方法，因为这种格式一般是提交信息
-                # multipart/form-data 同样是提交信息，对应用request.post()方法，但是处理方式不同。
-                if not request.content_type:
-                    return web.HTTPBadRequest(reason='Missing Content-Type.')
-                # 将contengt-type转换为小写，同时将其转换为字符串
-                ct = request.content_type.lower()
-                # startswith 是针对字符串string的一个方法，判断是否以xx为开头
-                if ct.startswith('application/json'):
-                    # 如果是json开头，则提取json格式的request结果
-                    params = await request.json()
-                    if not isinstance(params, dict):
-                        return web.HTTPBadRequest(reason='JSON body must be object.')
-                    kw = params
-                elif ct.startswith('application/x-www-form-urlencoded') or ct.startswith('multipart/form-data'):
-                    params = await request.post()
-                    kw = dict(**params)
-                else:
-                    return web.HTTPBadRequest(reason='Unsupported Content-Type: %s' % request.content_type)
+    def _make_binder(self):
+        # 绑定函数接收 request 和解析好的 body，返回调用 handler 的参数 kw，出错时返回一个 Response
+        has_request_arg = self._has_request_arg
+        if not self._parse_body:
+            # 没有关键字参数：不需要解析 body 和查询字符串，只传入 URL 中的参数
+            # match_info方法是提取url中的参数
+            if has_request_arg:
+                def bind(request, params):
+                    kw = dict(request.match_info)
+                    kw['request'] = request
+                    return kw
+            else:
+                def bind(request, params):
+                    return dict(request.match_info)
+            return bind
+        # 有 **kw 时保留所有参数，否则只保留声明过的关键字参数
+        named_kw_args = None if self._has_var_kw_arg else self._named_kw_args
+        # 只有 **kw 或声明了 cursor 参数的 handler 才需要解码分页游标
+        decode_cursor_arg = named_kw_args is None or 'cursor' in named_kw_args
+        required_kw_args = self._required_kw_args
+
+        def bind(request, params):
+            kw = params
             if request.method == 'GET':
                 # query_string返回url中的查询字符串
                 qs = request.query_string
                 if qs:
-                    kw = dict()
                     # parse.parse_qs是urllib库中的一个方法，用于将url字符串分割
                     # urllib.parse.parse_qs() 能够将url的查询参数进行解析，解析后返回一个字典
-                    # 例如 http://docs.python.org:80/3/library/urllib.parse.html?highlight=params#url-parsing
-                    # 这个url里面的highlight=就是查询的内容，前面是连接路径
-                    # parse_qs就是查询这个highlight=xx的内容，并返回字典
-                    # 字典的key 是前面链接部分http://docs.python.org:80/3/library/urllib.parse.html?highlight
-                    # 字典的value 是等于号后面部分['params#url-parsing']
+                    # 例如 ?highlight=params#url-parsing 解析为 {'highlight': ['params#url-parsing']}
                     # 提取具体内容用value[0] >>> params#url-parsing
-                    # 因为是字典，所以提取是采用.items()方法
-                    for k, v in parse.parse_qs(qs, True).items():
-                        kw[k] = v[0]
-        if kw is None:
-            # match_info方法是提取url中的参数
-            kw = dict(**request.match_info)
-        else:
-            if not self._has_var_kw_arg and self._named_kw_args:
-                # remove all unamed kw:
-                copy = dict()
-                for name in self._named_kw_args:
-                    if name in kw:
-                        copy[name] = kw[name]
-                kw = copy
-            # check named arg:
-            for k, v in request.match_info.items():
-                if k in kw:
-                    logging.warning(
-                        'Duplicate arg name in named arg and kw args: %s' % k)
-                kw[k] = v
-        if self._has_request_arg:
-            kw['request'] = request
-        # check required kw:
-        if self._required_kw_args:
-            for name in self._required_kw_args:
-                if not name in kw:
+                    kw = dict((k, v[0]) for k, v in parse.parse_qs(qs, True).items())
+                    # 分页游标 ?cursor=xx 在这里解码，传给 handler 的是 (排序列, 值, 主键)
+                    # 可以直接交给 Model.findPage；格式不对直接返回400
+                    if decode_cursor_arg and 'cursor' in kw:
+                        try:
+                            kw['cursor'] = decode_cursor(kw['cursor']) if kw['cursor'] else None
+                        except CursorError:
+                            return web.HTTPBadRequest(reason='Invalid cursor.')
+            if kw is None:
+                kw = dict(request.match_info)
+            else:
+                if named_kw_args is not None:
+                    # remove all unamed kw:
+                    kw = dict((name, kw[name]) for name in named_kw_args if name in kw)
+                # check named arg:
+                for k, v in request.match_info.items():
+                    if k in kw:
+                        logging.warning('Duplicate arg name in named arg and kw args: %s', k)
+                    kw[k] = v
+            if has_request_arg:
+                kw['request'] = request
+            # check required kw:
+            for name in required_kw_args:
+                if name not in kw:
                     return web.HTTPBadRequest(reason='Missing argument: %s' % name)
-        logging.info('call with args: %s' % str(kw))
+            return kw
+        return bind
+
+    async def __call__(self, request):
+        params = None
+        if self._parse_body and request.method == 'POST':
+            params = await parse_body(request)
+            if not isinstance(params, dict):
+                return params
+        kw = self._bind(request, params)
+        if not isinstance(kw, dict):
+            return kw
+        # 日志参数在真正输出时才格式化
+        logging.info('call with args: %s', kw)
         try:
-            r = await self._func(**kw)
+            # 一个请求内 prefetch 加载的同一行只构造一次，写入后的查询发给主库
+            with identity_map(), db_session():
+                r = await self._func(**kw)
             return r
         except APIError as e:
             return dict(error=e.error, data=e.data, message=e.message)
+        except CursorError:
+            # 游标能解码，但和 handler 的查询不匹配（例如按其他列排序）
+            return web.HTTPBadRequest(reason='Invalid cursor.')
+        except PoolTimeout:
+            # 数据库连接用完了，让客户端稍后重试，而不是一直排队
+            logging.warning('database pool exhausted: %s %s', request.method, request.path)
+            return web.HTTPServiceUnavailable(headers={'Retry-After': '1'})
+
+# 读取 POST 请求的 body，返回参数字典，出错时返回一个 Response
+
+
+async def parse_body(request):
+    # request 主要见https://docs.aiohttp.org/en/stable/web_reference.html
+    # 判断是否header中带有content-type
+    # content-type主要是告诉服务器，接下来reqeust的内容格式是什么
+    # https://juejin.cn/post/6868277123824975886
+    # https://blog.csdn.net/woaixiaoyu520/article/details/76690686
+    # application/json 对应用request.json()方法
+    # application/x-www-form-urlencoded 对应用request.post()方法，因为这种格式一般是提交信息
+    # multipart/form-data 同样是提交信息，对应用request.post()方法，但是处理方式不同。
+    if not request.content_type:
+        return web.HTTPBadRequest(reason='Missing Content-Type.')
+    # 将contengt-type转换为小写，同时将其转换为字符串
+    ct = request.content_type.lower()
+    # startswith 是针对字符串string的一个方法，判断是否以xx为开头
+    if ct.startswith('application/json'):
+        # 如果是json开头，则提取json格式的request结果
+        params = await request.json(loads=serializer.loads)
+        if not isinstance(params, dict):
+            return web.HTTPBadRequest(reason='JSON body must be object.')
+        return params
+    if ct.startswith('application/x-www-form-urlencoded') or ct.startswith('multipart/form-data'):
+        params = await request.post()
+        return dict(**params)
+    return web.HTTPBadRequest(reason='Unsupported Content-Type: %s' % request.content_type)
 
 
 def add_static(app):
     path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static')
-    app.router.add_static('/static/', path)
+    # 预先生成 .gz/.br 文件（已是最新的会跳过），aiohttp 按 Accept-Encoding 直接发送压缩好的文件
+    precompress(path)
+    # 带指纹的静态文件 URL，见 assets.py
+    manifest = AssetManifest(path).build()
+    app['__assets__'] = manifest
+    app.router.add_get('/static/{filename:.+}', manifest.handle)
+    # 模版中通过 static_url 生成 URL；init_jinja2 要在 add_static 之前调用
+    env = app.get('__templating__')
+    if env is not None:
+        env.globals['static_url'] = manifest.url
+        env.filters['static_url'] = manifest.url
     logging.info('add static %s => %s' % ('/static/', path))
 
 
+def as_coroutine(fn):
+    ' wrap a plain function into a coroutine function, awaiting its result if it is awaitable. '
+    # @get/@post 返回的 wrapper 是普通函数，调用后得到 handler 的协程，这里一并 await
+    # functools.wraps 保留 __wrapped__，inspect.signature 仍然能取到原函数的参数
+    @functools.wraps(fn)
+    async def wrapper(*args, **kw):
+        r = fn(*args, **kw)
+        if inspect.isawaitable(r):
+            r = await r
+        return r
+    return wrapper
+
+
 def add_route(app, fn):
     # app参数接受自aiohttp app = web.Application()
     # fn是具体的handler实例
@@ -218,15 +283,18 @@ def add_route(app, fn):
     # 判断是否提取到了url的方法和路径
     if path is None or method is None:
         raise ValueError('@get or @post not defined in %s.' % str(fn))
-    # 判断该url处理函数 是否为一个协程，inspect模块主要用于检查是否为生成器
-    if not asyncio.iscoroutinefunction(fn) and not inspect.isgeneratorfunction(fn):
-        fn = asyncio.coroutine(fn)
+    # 判断该url处理函数 是否为一个协程，不是的话包装成协程
+    if not asyncio.iscoroutinefunction(fn):
+        fn = as_coroutine(fn)
     logging.info('add route %s %s => %s(%s)' % (
         method, path, fn.__name__, ', '.join(inspect.signature(fn).parameters.keys())))
     # add_route方法，当接收到 meth path 这类输入后，采用RequestHandeler函数进行处理
     # 例如 app.router.add_route('GET', '/hello/{name}', hello)
     # 指示，用hello函数，处理get方法请求/hellp/name路径的输入
-    app.router.add_route(method, path, RequestHandler(app, fn))
+    # 注册 RequestHandler 的 __call__（绑定方法是协程函数）而不是实例本身：
+    # aiohttp 会把不是协程函数的 handler 包装起来并要求返回 Response，
+    # 而这里返回的 dict/str 要交给 response_factory 转换
+    app.router.add_route(method, path, RequestHandler(app, fn).__call__)
 # 需要注册的函数可能有很多，所以写一个routes的函数，自动扫描后进行注册
 # 使用方式是 add_routes(app, '模块名称')
 
@@ -254,23 +322,9 @@ def add_routes(app, module_name):
             continue
         # 得到这个函数的属性 <function index at 0x0000015D82EE7158>
         fn = getattr(mod, attr)
-        print('注册函数: %s' % fn)
         if callable(fn):
-            print('函数%s is callable' % fn)
             method = getattr(fn, '__method__', None)
             path = getattr(fn, '__route__', None)
             if method and path:
                 add_route(app, fn)
-
-    # 判断这个函数是否合法，即参数内是否有request
-    sig = inspect.signature(fn)
-    params = sig.parameters
-    found = False
-    for name, param in params.items():
-        if name == 'request':
-            found = True
-            continue
-        if found and (param.kind != inspect.Parameter.VAR_POSITIONAL and param.kind != inspect.Parameter.KEYWORD_ONLY and param.kind != inspect.Parameter.VAR_KEYWORD):
-            raise ValueError('request parameter must be the last named parameter in function: %s%s' % (
-                fn.__name__, str(sig)))
-    return
+    # request 参数是否合法由 RequestHandler 注册时的 has_request_arg 逐个检查
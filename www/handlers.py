@@ -8,15 +8,26 @@
 
 # here put the import lib
 
+from aiohttp import web
 from coroweb import get
+import metrics
 
-from model import User
+from model import User, Blog
 
 @get('/')
 async def index(request):
     users = await User.findAll()
-    print(users)
     return {
         '__template__': 'test.html',
         'users': users
-    }
\ No newline at end of file
+    }
+
+@get('/api/blogs')
+async def api_blogs(*, cursor=None):
+    blogs, next_cursor = await Blog.findPage(limit=10, cursor=cursor)
+    return dict(blogs=blogs, cursor=next_cursor)
+
+@get('/metrics')
+async def show_metrics():
+    # Prometheus 文本格式
+    return web.Response(text=metrics.render(), content_type='text/plain')
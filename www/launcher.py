@@ -0,0 +1,220 @@
+# -*- encoding: utf-8 -*-
+'''
+@File    :   launcher.py
+@Time    :   2026/10/18 16:48:03
+'''
+
+# here put the import lib
+# 多进程启动：python launcher.py
+# 主进程只负责管理，fork 出 conf 中 web.workers 个工作进程，每个工作进程有自己的事件循环和数据库连接池
+# 工作进程用 SO_REUSEPORT 绑定同一个端口，由内核把连接分给各个进程；
+# 没有 SO_REUSEPORT 的系统上，主进程先创建监听 socket，工作进程共享它来 accept
+# 信号（发给主进程）：
+#     SIGTERM / SIGINT  平滑退出：工作进程停止接受新连接，处理完已有的请求后退出
+#     SIGHUP            平滑重启：重新读取配置，启动一组新的工作进程，再让旧的平滑退出
+#                       app 在 fork 之后才导入，新的工作进程会加载修改过的代码
+# 工作进程意外退出时，主进程会重新启动一个
+# 只支持 Linux / macOS 这类有 fork 的系统
+
+import os
+import sys
+import time
+import select
+import socket
+import signal
+import asyncio
+import importlib
+import logging
+logging.basicConfig(level=logging.INFO)
+
+# conf 在项目根目录下
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def load_configs():
+    # SIGHUP 时重新读取配置文件，config_override 可以不存在
+    from conf import config
+    for name in ('conf.config_default', 'conf.config_override'):
+        if name in sys.modules:
+            importlib.reload(sys.modules[name])
+    return importlib.reload(config).configs
+
+
+def run_worker(configs, sock=None, ready=None):
+    # 工作进程不处理 Ctrl-C，由主进程统一发送 SIGTERM
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    import app
+    loop = app.new_event_loop(configs.web.uvloop)
+    asyncio.set_event_loop(loop)
+    runner = loop.run_until_complete(app.init(configs, reuse_port=sock is None, sock=sock))
+    loop.add_signal_handler(signal.SIGTERM, loop.stop)
+    logging.info('worker %s started' % os.getpid())
+    # 通知主进程已经开始监听
+    if ready is not None:
+        os.write(ready, b'1')
+        os.close(ready)
+    try:
+        loop.run_forever()
+    finally:
+        logging.info('worker %s shutting down...' % os.getpid())
+        loop.run_until_complete(runner.cleanup())
+        loop.close()
+
+
+class Master(object):
+    '''
+    forks the workers and restarts them on exit, reload or shutdown.
+    '''
+
+    def __init__(self):
+        self.configs = load_configs()
+        self.workers = set()
+        # 正在退出的旧工作进程，退出时不需要重新启动
+        self.retiring = set()
+        self.sock = None
+        self._signal = None
+
+    def worker_count(self):
+        return self.configs.web.workers or os.cpu_count() or 1
+
+    def listen(self):
+        if hasattr(socket, 'SO_REUSEPORT'):
+            return None
+        web = self.configs.web
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind((web.host, web.port))
+        sock.listen(1024)
+        sock.setblocking(False)
+        return sock
+
+    def spawn(self):
+        ' fork a worker, returns (pid, read end of a pipe that receives b"1" once it listens). '
+        r, w = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(r)
+            code = 0
+            try:
+                run_worker(self.configs, self.sock, w)
+            except BaseException:
+                logging.exception('worker %s failed' % os.getpid())
+                code = 1
+            finally:
+                # 不执行主进程的清理代码
+                os._exit(code)
+        os.close(w)
+        self.workers.add(pid)
+        return pid, r
+
+    def wait_ready(self, spawned, timeout=30):
+        ' wait for the (pid, fd) pairs from spawn, returns the pids that started listening. '
+        deadline = time.monotonic() + timeout
+        fds = dict((fd, pid) for pid, fd in spawned)
+        ready = set()
+        while fds and time.monotonic() < deadline:
+            readable, _, _ = select.select(list(fds), [], [], max(deadline - time.monotonic(), 0))
+            for fd in readable:
+                # 读到 b'1' 表示已经在监听；EOF 表示工作进程启动失败，都不再等待
+                if os.read(fd, 1) == b'1':
+                    ready.add(fds[fd])
+                os.close(fd)
+                del fds[fd]
+        for fd in fds:
+            os.close(fd)
+        return ready
+
+    def kill(self, pids, sig=signal.SIGTERM):
+        for pid in pids:
+            try:
+                os.kill(pid, sig)
+            except ProcessLookupError:
+                pass
+
+    def reap(self):
+        ' collect exited workers, returns the pids that exited unexpectedly. '
+        died = []
+        while True:
+            try:
+                pid, _ = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                break
+            if pid == 0:
+                break
+            if pid in self.retiring:
+                self.retiring.discard(pid)
+            elif pid in self.workers:
+                died.append(pid)
+            self.workers.discard(pid)
+        return died
+
+    def handle_signal(self, signum, frame):
+        # 信号处理函数中只记录，在主循环中处理
+        self._signal = signum
+
+    def reload(self):
+        logging.info('reloading workers...')
+        configs = self.configs
+        old = set(self.workers)
+        try:
+            self.configs = load_configs()
+        except Exception:
+            logging.exception('failed to reload configs, keeping the old workers')
+            self.configs = configs
+            return
+        spawned = [self.spawn() for _ in range(self.worker_count())]
+        new = set(pid for pid, _ in spawned)
+        ready = self.wait_ready(spawned)
+        if ready != new:
+            # 有新的工作进程没有启动成功（例如修改的代码有错误），放弃这次重启，旧的工作进程继续服务
+            logging.error('reload failed: %s of %s new workers started, keeping the old workers',
+                          len(ready), len(new))
+            self.configs = configs
+            self.workers -= new
+            self.retiring |= new
+            self.kill(new)
+            return
+        # 新的工作进程都已经在监听，旧的不再接受新连接，处理完已有请求后退出
+        self.workers -= old
+        self.retiring |= old
+        self.kill(old)
+
+    def stop(self):
+        logging.info('stopping %s workers...' % len(self.workers))
+        pids = self.workers | self.retiring
+        self.retiring = pids
+        self.workers = set()
+        self.kill(pids)
+        deadline = time.monotonic() + self.configs.web.shutdown_timeout + 5
+        while self.retiring and time.monotonic() < deadline:
+            self.reap()
+            time.sleep(0.1)
+        # 超时仍未退出的强制结束
+        self.kill(self.retiring, signal.SIGKILL)
+        self.reap()
+
+    def run(self):
+        self.sock = self.listen()
+        for sig in (signal.SIGTERM, signal.SIGINT, signal.SIGHUP):
+            signal.signal(sig, self.handle_signal)
+        self.wait_ready([self.spawn() for _ in range(self.worker_count())])
+        logging.info('master %s started %s workers' % (os.getpid(), len(self.workers)))
+        while True:
+            sig, self._signal = self._signal, None
+            if sig in (signal.SIGTERM, signal.SIGINT):
+                self.stop()
+                return
+            if sig == signal.SIGHUP:
+                self.reload()
+            for pid in self.reap():
+                logging.warning('worker %s exited, restarting...' % pid)
+                # 避免启动就失败的工作进程不停地重启
+                time.sleep(1)
+                self.wait_ready([self.spawn()])
+            time.sleep(0.2)
+
+
+if __name__ == '__main__':
+    Master().run()
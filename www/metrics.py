@@ -0,0 +1,150 @@
+# -*- encoding: utf-8 -*-
+'''
+@File    :   metrics.py
+@Time    :   2026/10/18 20:12:36
+'''
+
+# here put the import lib
+# 运行指标，GET /metrics 以 Prometheus 的文本格式输出
+# 1. 每个路由的请求耗时直方图和按状态码的请求数（app.py 的 metrics_factory）
+# 2. 每条 SQL 语句的耗时直方图和返回/影响的行数（orm 的 _select / _execute）
+# 3. 连接池的连接数、空闲数、等待数，以及等待连接的耗时（orm 注册）
+# 记录时只做字典查找和整数加法：标签用 route 对象、SQL 字符串本身做 key，输出时才格式化
+# 所有记录都在事件循环线程中进行，不需要加锁
+
+import bisect
+
+# 直方图的分桶上界（秒）
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# 不同的 SQL 语句最多记录这么多条，超过的合并到 'other'，避免 in (?, ?, ...) 这类语句无限增长
+MAX_STATEMENTS = 1000
+
+
+class Histogram(object):
+
+    __slots__ = ('buckets', 'counts', 'sum', 'count')
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        # 最后一个是超过所有上界的（+Inf）
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self):
+        ' yield (upper bound, cumulative count), ending with +Inf. '
+        total = 0
+        for le, n in zip(self.buckets + (float('inf'),), self.counts):
+            total += n
+            yield le, total
+
+
+# (route, method) => Histogram
+_requests = dict()
+# (route, method, status) => 请求数
+_responses = dict()
+# sql => Histogram
+_statements = dict()
+# sql => 行数
+_rows = dict()
+# name => (help, 取值函数)
+_gauges = dict()
+# name => (help, Histogram)
+_histograms = dict()
+
+
+def observe_request(route, method, status, elapsed):
+    # 没有匹配到路由时 aiohttp 每次都创建新的 SystemRoute，统一记为 None，否则每个 404 都是一个新的序列
+    if getattr(route, 'resource', None) is None:
+        route = None
+    key = (route, method)
+    h = _requests.get(key)
+    if h is None:
+        h = _requests[key] = Histogram()
+    h.observe(elapsed)
+    key = (route, method, status)
+    _responses[key] = _responses.get(key, 0) + 1
+
+
+def observe_sql(sql, elapsed, rows):
+    h = _statements.get(sql)
+    if h is None:
+        if len(_statements) >= MAX_STATEMENTS:
+            sql = 'other'
+            h = _statements.get(sql)
+        if h is None:
+            h = _statements[sql] = Histogram()
+    h.observe(elapsed)
+    _rows[sql] = _rows.get(sql, 0) + rows
+
+
+def gauge(name, help, fn):
+    ' register a gauge whose value is read from fn() when the metrics are rendered. '
+    _gauges[name] = (help, fn)
+
+
+def histogram(name, help, buckets=BUCKETS):
+    ' register and return a named histogram without labels. '
+    h = Histogram(buckets)
+    _histograms[name] = (help, h)
+    return h
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _route_label(route):
+    resource = getattr(route, 'resource', None)
+    if resource is None:
+        # 没有匹配到路由（404/405）
+        return 'unmatched'
+    return resource.canonical
+
+
+def _format_histogram(L, name, labels, h):
+    for le, n in h.cumulative():
+        L.append('%s_bucket{%sle="%s"} %s' % (name, labels, '+Inf' if le == float('inf') else le, n))
+    labels = labels.rstrip(',')
+    labels = '{%s}' % labels if labels else ''
+    L.append('%s_sum%s %s' % (name, labels, h.sum))
+    L.append('%s_count%s %s' % (name, labels, h.count))
+
+
+def render():
+    ' render all metrics in the Prometheus text exposition format. '
+    L = []
+    L.append('# HELP http_request_duration_seconds Request latency by route.')
+    L.append('# TYPE http_request_duration_seconds histogram')
+    for (route, method), h in list(_requests.items()):
+        labels = 'route="%s",method="%s",' % (_escape(_route_label(route)), method)
+        _format_histogram(L, 'http_request_duration_seconds', labels, h)
+    L.append('# HELP http_requests_total Requests by route and status.')
+    L.append('# TYPE http_requests_total counter')
+    for (route, method, status), n in list(_responses.items()):
+        L.append('http_requests_total{route="%s",method="%s",status="%s"} %s' % (
+            _escape(_route_label(route)), method, status, n))
+    L.append('# HELP db_query_duration_seconds Execution time by SQL statement.')
+    L.append('# TYPE db_query_duration_seconds histogram')
+    for sql, h in list(_statements.items()):
+        _format_histogram(L, 'db_query_duration_seconds', 'sql="%s",' % _escape(sql), h)
+    L.append('# HELP db_query_rows_total Rows returned or affected by SQL statement.')
+    L.append('# TYPE db_query_rows_total counter')
+    for sql, n in list(_rows.items()):
+        L.append('db_query_rows_total{sql="%s"} %s' % (_escape(sql), n))
+    for name, (help, h) in list(_histograms.items()):
+        L.append('# HELP %s %s' % (name, help))
+        L.append('# TYPE %s histogram' % name)
+        _format_histogram(L, name, '', h)
+    for name, (help, fn) in list(_gauges.items()):
+        L.append('# HELP %s %s' % (name, help))
+        L.append('# TYPE %s gauge' % name)
+        L.append('%s %s' % (name, fn()))
+    L.append('')
+    return '\n'.join(L)
@@ -7,7 +7,7 @@
 '''
 import time, uuid
 
-from orm import Model, StringField, BooleanField, FloatField, TextField
+from orm import Model, StringField, BooleanField, FloatField, TextField, Relation
 
 def next_id():
     # 这个函数主要是用于当没有输入id时，默认生成以当前时间为基础的一个id
@@ -22,6 +22,8 @@ def next_id():
 # 构造我们后续webapp需要用到的三个table
 class User(Model):
     __table__ = 'users'
+    # 首页每次都查询全部用户，结果缓存 10 秒，保存/修改用户时自动失效
+    __cache_ttl__ = 10
 
     id = StringField(primary_key=True, default=next_id, ddl='varchar(50)')
     email = StringField(ddl='varchar(50)')
@@ -40,11 +42,18 @@ class Blog(Model):
     user_image = StringField(ddl='varchar(500)')
     name = StringField(ddl='varchar(50)')
     summary = StringField(ddl='varchar(200)')
-    content = TextField()
+    # 列表页只显示摘要，正文按需用 Blog.load_deferred 加载
+    content = TextField(lazy=True)
     created_at = FloatField(default=time.time)
 
+    user = Relation('User', 'user_id')
+    comments = Relation('Comment', 'blog_id', many=True)
+
 class Comment(Model):
     __table__ = 'comments'
+    # 评论按 blog_id 分片，分片在 db 配置的 shards['comments'] 中设置；没有配置时都在主库
+    __shards__ = 'comments'
+    __shard_key__ = 'blog_id'
 
     id = StringField(primary_key=True, default=next_id, ddl='varchar(50)')
     blog_id = StringField(ddl='varchar(50)')
@@ -53,3 +62,6 @@ class Comment(Model):
     user_image = StringField(ddl='varchar(500)')
     content = TextField()
     created_at = FloatField(default=time.time)
+
+    user = Relation('User', 'user_id')
+    blog = Relation('Blog', 'blog_id')
@@ -10,63 +10,506 @@
 # 用于web 访问数据库，处理数据
 # 创建函数，用于执行Select insert update delete 操作
 
+import re
 import time
 import json
+import zlib
 import os
+import base64
 from aiohttp import web
 from datetime import datetime
-import aiomysql
+import functools
+import backends
+from cache import MemoryCache
+from pool import Pool, PoolTimeout
+import metrics
 import asyncio
+import contextvars
+from collections import OrderedDict
+from contextlib import asynccontextmanager, contextmanager
 import logging
 logging.basicConfig(level=logging.INFO)
 
+# SQL 日志量很大，单独使用一个 logger，可以抽样或关闭，见 applog.py
+_sql_log = logging.getLogger('orm.sql')
+
 
-# @asyncio.coroutine 这个装饰器的作用是让这个函数的操作变成协程
 # 创建连接池
 # create_pool函数最基本的功能就是创建一个和Mysql数据库的连接
-# 函数传入一个参数loop，loop为通过asyncio创建的连接事件
+# 参数就是 conf/config.py 中的 db 配置：orm.create_pool(**configs.db)
+# 连接池使用当前正在运行的事件循环，不再需要传入 loop
+# 连接池的预热、回收、超时和自适应大小见 pool.py，参数同样来自 db 配置
+# 读写分离：db 配置中的 replicas 是只读副本，名字 => 和主库不同的配置项（例如 host），其余沿用主库的配置
+#     'replicas': {'replica1': {'host': '10.0.0.2'}, 'replica2': {'host': '10.0.0.3'}}
+# 查询（select、find、findAll、findNumber）发给副本，写入（execute、save、update、remove）和事务中的语句发给主库
+# routing 决定选哪个副本：'round_robin' 轮流，'least_busy' 选借出和等待的连接最少的
+# sticky 为 True 时，一个请求写入过之后，这个请求后面的查询都发给主库（读到自己的写入，不受复制延迟影响）
+# 也可以用 with orm.use_primary(): 强制块内的查询发给主库
+# 分片：db 配置中的 shards 是分片组，组名 => 每个分片和主库不同的配置项，连接池依次命名为 组名0、组名1 ...
+#     'shards': {'comments': [{'database': 'awesome_c0'}, {'database': 'awesome_c1'}]}
+# Model 用 __shards__ 指定分片组、__shard_key__ 指定分片键，见下面 Model 的分片部分；没有配置的分片组照常使用主库
 
 
-@asyncio.coroutine
-async def create_pool(loop, **kw):
-    logging.info('create database connection pool...')
-    # 把__pool设置为全局变量，再将其定义为一个和数据库的连接
-    global __pool
-    __pool = await aiomysql.create_pool(
-        host=kw.get('host', 'localhost'),
-        port=kw.get('port', 3306),
-        user=kw['user'],
-        password=kw['password'],
-        # db参数为要连接使用的数据库database
-        db=kw['db'],
-        charset=kw.get('charset', 'utf8'),
-        autocommit=kw.get('autocommit', True),
+def _make_pool(kw):
+    return Pool(
+        _backend.connector(kw),
         # 设置最小和最大的连接数
-        maxsize=kw.get('maxsize', 10),
         minsize=kw.get('minsize', 1),
-        loop=loop
+        maxsize=kw.get('maxsize', 10),
+        recycle=kw.get('recycle', 3600),
+        ping_interval=kw.get('ping_interval', 30),
+        acquire_timeout=kw.get('acquire_timeout', 5),
+        adaptive=kw.get('adaptive', False),
+        adaptive_maxsize=kw.get('adaptive_maxsize', 50),
+        adaptive_wait=kw.get('adaptive_wait', 0.005)
     )
 
+
+# 数据库驱动，db 配置中的 backend，见 backends.py
+_backend = None
+# 名字 => 连接池，主库叫 primary
+_pools = dict()
+# 只读副本的连接池
+_replicas = []
+_routing = 'round_robin'
+_sticky = True
+_next_replica = 0
+# 分片组 => 各分片的连接池名字
+_shards = dict()
+
+
+async def create_pool(**kw):
+    logging.info('create database connection pool...')
+    # 把__pool设置为全局变量，再将其定义为一个和数据库的连接
+    global __pool, _replicas, _routing, _sticky, _backend
+    _backend = backends.get_backend(kw.pop('backend', 'mysql'))
+    replicas = kw.pop('replicas', None) or dict()
+    shards = kw.pop('shards', None) or dict()
+    _routing = kw.pop('routing', 'round_robin')
+    _sticky = kw.pop('sticky', True)
+    __pool = _pools['primary'] = _make_pool(kw)
+    _replicas = []
+    for name, overrides in replicas.items():
+        _pools[name] = _make_pool(dict(kw, **overrides))
+        _replicas.append(_pools[name])
+    _shards.clear()
+    for group, members in shards.items():
+        names = []
+        for i, overrides in enumerate(members):
+            name = '%s%s' % (group, i)
+            _pools[name] = _make_pool(dict(kw, **overrides))
+            names.append(name)
+        _shards[group] = names
+    await asyncio.gather(*[p.warm_up() for p in _pools.values()])
+    if _replicas:
+        logging.info('read replicas: %s (%s)', ', '.join(replicas), _routing)
+    for group, names in _shards.items():
+        logging.info('shards of %s: %s', group, ', '.join(names))
+
+
+async def close_pool():
+    ' close the connection pools and wait until every connection is released. '
+    global __pool, _replicas
+    pools = list(_pools.values())
+    __pool = None
+    _pools.clear()
+    _shards.clear()
+    _replicas = []
+    for pool in pools:
+        pool.close()
+    await asyncio.gather(*[pool.wait_closed() for pool in pools])
+    if _backend is not None:
+        await _backend.close()
+
+# 当前任务正在进行的事务，用 contextvars 保存，保证并发的 handler 之间互不影响
+_transaction = contextvars.ContextVar('transaction', default=None)
+
+
+class Transaction(object):
+    ' a pooled connection pinned to the current task until the transaction ends. '
+
+    def __init__(self, conn):
+        self.conn = conn
+        # 事务中写过的表，提交后再使一次结果缓存失效
+        self.tables = set()
+
+# 一个请求的读写状态，RequestHandler 用 db_session() 为每个请求创建
+# 写入后 primary 置为 True，之后的查询都发给主库；asyncio.gather 创建的子任务共享同一个对象
+
+
+class Session(object):
+    __slots__ = ('primary',)
+
+    def __init__(self):
+        self.primary = False
+
+
+_session = contextvars.ContextVar('session', default=None)
+
+
+@contextmanager
+def db_session():
+    token = _session.set(Session())
+    try:
+        yield
+    finally:
+        _session.reset(token)
+
+
+_force_primary = contextvars.ContextVar('force_primary', default=False)
+
+
+@contextmanager
+def use_primary():
+    ' send the queries inside the block to the primary. '
+    token = _force_primary.set(True)
+    try:
+        yield
+    finally:
+        _force_primary.reset(token)
+
+
+def _mark_write():
+    session = _session.get()
+    if session is not None and _sticky:
+        session.primary = True
+
+
+def _choose_replica():
+    global _next_replica
+    if _routing == 'least_busy':
+        return min(_replicas, key=lambda p: p.busy)
+    _next_replica = (_next_replica + 1) % len(_replicas)
+    return _replicas[_next_replica]
+
+
+def _read_pool():
+    if not _replicas:
+        return __pool
+    session = _session.get()
+    if _force_primary.get() or (session is not None and session.primary):
+        return __pool
+    return _choose_replica()
+
+
+async def _acquire(pool):
+    global _waiters
+    start = time.perf_counter()
+    _waiters += 1
+    try:
+        conn = await pool.acquire()
+    finally:
+        _waiters -= 1
+    _acquire_time.observe(time.perf_counter() - start)
+    return conn
+
+# 指定语句在哪个连接池上执行，分片时使用；None 表示按上面的规则选择主库或副本
+_shard = contextvars.ContextVar('shard', default=None)
+
+
+@contextmanager
+def use_pool(name):
+    ' run the statements inside the block on the named pool, e.g. a shard. '
+    token = _shard.set(name)
+    try:
+        yield
+    finally:
+        _shard.reset(token)
+
+# 取得一个连接：事务中返回事务固定的连接，否则从连接池中借一个，用完归还
+# readonly 为 True 时从副本借，副本连不上（不包括等待超时）时改用主库
+# 指定了分片（shard 参数或 use_pool）时直接从分片的连接池借；分片上的语句不加入主库的事务
+
+
+@asynccontextmanager
+async def _connection(readonly=False, shard=None):
+    name = shard or _shard.get()
+    if name is not None:
+        pool = _pools[name]
+        conn = await _acquire(pool)
+        try:
+            yield conn
+        finally:
+            await pool.release(conn)
+        return
+    tx = _transaction.get()
+    if tx is not None:
+        yield tx.conn
+        return
+    pool = _read_pool() if readonly else __pool
+    try:
+        conn = await _acquire(pool)
+    except PoolTimeout:
+        raise
+    except Exception as e:
+        if pool is __pool:
+            raise
+        logging.warning('replica unavailable, reading from primary: %s', e)
+        pool = __pool
+        conn = await _acquire(pool)
+    try:
+        yield conn
+    finally:
+        await pool.release(conn)
+
+# 连接池的状态，/metrics 输出时读取
+# 正在等待空闲连接的协程数
+_waiters = 0
+_acquire_time = metrics.histogram('db_pool_acquire_seconds', 'Time spent waiting for a pooled connection.')
+
+
+def _pool_stat(name):
+    pool = globals().get('__pool')
+    return getattr(pool, name) if pool is not None else 0
+
+
+metrics.gauge('db_pool_size', 'Connections opened by the pool.', lambda: _pool_stat('size'))
+metrics.gauge('db_pool_free', 'Idle connections in the pool.', lambda: _pool_stat('freesize'))
+metrics.gauge('db_pool_maxsize', 'Upper bound of the pool size.', lambda: _pool_stat('maxsize'))
+metrics.gauge('db_pool_waiters', 'Coroutines waiting for a connection.', lambda: _waiters)
+metrics.gauge('db_pool_wait_seconds', 'Moving average of the connection wait time.', lambda: _pool_stat('wait'))
+
+# 事务：
+# async with orm.transaction():
+#     await blog.save()
+#     await comment.save()
+# 块内所有 select/execute（包括 Model 的 find/findAll/save/update/remove）
+# 都在同一个连接上执行，正常退出时提交一次，出现异常则回滚
+# 嵌套的 transaction() 直接加入外层事务
+# 注意：在事务中用 asyncio.gather 等方式创建的子任务会继承这个事务，不要在其中并发执行语句
+
+
+@asynccontextmanager
+async def transaction():
+    tx = _transaction.get()
+    if tx is not None:
+        yield tx
+        return
+    async with _connection() as conn:
+        tx = Transaction(conn)
+        token = _transaction.set(tx)
+        try:
+            await conn.begin()
+            yield tx
+            await conn.commit()
+            for table in tx.tables:
+                await _result_cache.invalidate(table)
+        except BaseException:
+            await conn.rollback()
+            raise
+        finally:
+            _transaction.reset(token)
+
+# 之所以要用replace，是因为sql和mysql的占位符不同，我们连接的是
+# mysql，但是输入的语句是sql，sql用的是？ mysql用的是%s
+# %s表示向语句中传递args参数
+# Model 内部用到的语句在元类中或 _sql_cache 中预先转换好，不必每次都 replace
+
+
+def _translate(sql):
+    return sql.replace('?', '%s')
+
+# 已经转换好占位符的语句缓存，LRU 淘汰
+# key 由调用方决定，例如 findAll 用 (model, where, orderBy, limit 的形状)
+
+
+class SQLCache(object):
+    ' bounded LRU cache of translated sql, counts hits and misses. '
+
+    def __init__(self, maxsize=512):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+
+    def get(self, key):
+        sql = self._data.get(key)
+        if sql is None:
+            self.misses += 1
+            return None
+        self._data.move_to_end(key)
+        self.hits += 1
+        return sql
+
+    def put(self, key, sql):
+        self._data[key] = sql
+        if len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def stats(self):
+        return dict(hits=self.hits, misses=self.misses, size=len(self._data), maxsize=self.maxsize)
+
+
+_sql_cache = SQLCache()
+
+
+def sql_cache_stats():
+    ' hit/miss counters of the prepared sql cache. '
+    return _sql_cache.stats()
+
+# 查询结果缓存，默认不启用；Model 子类设置 __cache_ttl__（秒）后，
+# find/findAll/findNumber 的结果按 (sql, args) 缓存，同一个表的 save/update/remove 会使其失效
+# 默认是进程内的 MemoryCache，可以用 set_cache_backend 换成其他 cache.CacheBackend 实现
+_result_cache = MemoryCache(maxsize=1024)
+
+
+def set_cache_backend(backend):
+    global _result_cache
+    _result_cache = backend
+
+
+async def _cached_select_one(cls, sql, args, size=None):
+    ttl = cls.__cache_ttl__
+    # 事务中可能读到自己还没提交的写入，不走缓存
+    if not ttl or _transaction.get() is not None:
+        return await _select(sql, args, size)
+    # 不同分片上同样的语句结果不同
+    key = (sql, tuple(args or ()), size, _shard.get())
+    rs = await _result_cache.get(cls.__table__, key)
+    if rs is None:
+        rs = await _select(sql, args, size)
+        await _result_cache.set(cls.__table__, key, rs, ttl)
+    return rs
+
+
+# 分片模型的查询：where 中有 分片键=? 时只查询一个分片，否则并发查询所有分片（scatter-gather），
+# 再按 orderBy 合并、按 limit 截取；where/orderBy/limit 是拼出 sql 时用的参数，不是分片模型时不需要
+
+
+async def _cached_select(cls, sql, args, size=None, where=None, orderBy=None, limit=None):
+    names = _shard_names(cls, where, args)
+    if names is None:
+        return await _cached_select_one(cls, sql, args, size)
+    if len(names) == 1:
+        return await _run_on(names[0], _cached_select_one, cls, sql, args, size)
+    if isinstance(limit, tuple):
+        # limit offset, n：每个分片都要取前 offset + n 行，合并后再跳过 offset 行
+        args = list(args)
+        args[-2:] = [0, limit[0] + limit[1]]
+    results = await asyncio.gather(*[_run_on(n, _cached_select_one, cls, sql, args, size) for n in names])
+    return _merge(results, orderBy, size if limit is None else limit)
+
+
+async def _run_on(name, fn, *args):
+    # gather 为每个协程创建单独的任务，各自的 use_pool 互不影响
+    if name is None:
+        return await fn(*args)
+    with use_pool(name):
+        return await fn(*args)
+
+
+def shard_hash(value, n):
+    ' default shard function: crc32 of the key value modulo the number of shards. '
+    return zlib.crc32(str(value).encode('utf-8')) % n
+
+
+_OR = re.compile(r'\bor\b', re.IGNORECASE)
+
+
+@functools.lru_cache(maxsize=256)
+def _shard_arg(key, where):
+    ' index in args of the shard key value, None when where does not pin a single shard. '
+    # 只识别用 and 连接的 `key`=? 条件，有 or 的条件可能涉及多个分片
+    if not where or _OR.search(where):
+        return None
+    m = re.search(r'(?<![\w.`])`?%s`?\s*=\s*\?' % re.escape(key), where)
+    if m is None:
+        return None
+    return where.count('?', 0, m.start())
+
+
+def _shard_names(cls, where, args):
+    ' pools a query on cls has to visit, None when cls is not sharded. '
+    names = _shards.get(cls.__shards__) if cls.__shards__ else None
+    if not names:
+        return None
+    i = _shard_arg(cls.__shard_key__, where)
+    if i is None:
+        return names
+    return [names[cls.__shard_fn__(args[i], len(names))]]
+
+
+def _write_shards(obj):
+    ' pools a write of obj goes to, None when obj is not sharded. '
+    names = _shards.get(obj.__shards__) if obj.__shards__ else None
+    if not names:
+        return None
+    value = getattr(obj, obj.__shard_key__, None)
+    if value is None:
+        # 没有取出分片键（例如投影查询的结果），按主键在所有分片上执行
+        return names
+    return [names[obj.__shard_fn__(value, len(names))]]
+
+
+async def _execute_on(names, sql, args):
+    if names is None:
+        return await _execute(sql, args)
+    return sum(await asyncio.gather(*[_run_on(n, _execute, sql, args) for n in names]))
+
+
+_ORDER_ITEM = re.compile(r'^`?(\w+)`?(?:\s+(asc|desc))?$', re.IGNORECASE)
+
+
+@functools.lru_cache(maxsize=256)
+def _order_columns(orderBy):
+    ' parse "a desc, `b`" into [(a, True), (b, False)], raise ValueError for expressions. '
+    columns = []
+    for item in orderBy.split(','):
+        m = _ORDER_ITEM.match(item.strip())
+        if m is None:
+            raise ValueError('Cannot merge shards ordered by: %s' % orderBy)
+        columns.append((m.group(1), (m.group(2) or '').lower() == 'desc'))
+    return columns
+
+
+def _merge(results, orderBy, limit):
+    rows = [r for rs in results for r in rs]
+    if orderBy:
+        # 从最后一个排序列开始逐列稳定排序；和 mysql 一样 NULL 在升序时排最前
+        for column, desc in reversed(_order_columns(orderBy)):
+            rows.sort(key=lambda r: (r[column] is not None, r[column]), reverse=desc)
+    if isinstance(limit, tuple):
+        return rows[limit[0]:limit[0] + limit[1]]
+    if limit is not None:
+        return rows[:limit]
+    return rows
+
+
+_AGGREGATES = dict(count=sum, sum=sum, max=max, min=min)
+
+
+def _combine(selectField, values):
+    ' combine the per-shard results of findNumber. '
+    field = selectField.strip().lower()
+    fn = _AGGREGATES.get(field.split('(', 1)[0].strip())
+    # count(distinct x) 在不同分片上可能重复计数，avg 不能直接合并
+    if fn is None or 'distinct' in field:
+        raise ValueError('Cannot combine %s across shards' % selectField)
+    values = [v for v in values if v is not None]
+    return fn(values) if values else None
+
+
+async def _invalidate(table):
+    await _result_cache.invalidate(table)
+    tx = _transaction.get()
+    if tx is not None:
+        tx.tables.add(table)
+
 # 定义一个函数，能够帮助我们执行SELECT操作，用于在数据库中选择数据
-# select函数传入sql语句
+# select函数传入sql语句，_select 传入已经转换好占位符的语句
 
 
-@asyncio.coroutine
-async def select(sql, args, size=None):
+async def _select(sql, args, size=None):
     # log是做记录
-    logging.info(sql, args)
-    # 全局变量
-    global __pool
-    # 从连接池中返回一个连接
-    with (await __pool) as conn:
+    _sql_log.info('SQL: %s, args: %s', sql, args)
+    # 从连接池中返回一个连接（事务中则复用事务的连接，有只读副本时从副本借）
+    async with _connection(readonly=True) as conn:
         # cursor 获取角标
-        # aiomysql.DictCursor是将返回的角标作为字典形式返回
-        cur = await conn.cursor(aiomysql.DictCursor)
+        # aiomysql.DictCursor是将返回的角标作为字典形式返回（其他驱动见 backends.py）
+        cur = await conn.cursor(_backend.dict_cursor)
+        start = time.perf_counter()
         # cursor的execute方法，执行SQL语句
-        # 之所以要用replace，是因为sql和mysql的占位符不同，我们连接的是
-        # mysql，但是输入的语句是sql，sql用的是？ mysql用的是%s
-        # %s表示向语句中传递args参数
-        await cur.execute(sql.replace('?', '%s'), args or ())
+        await cur.execute(sql, args or ())
         # 是否调用函数时有输入size参数
         if size:
             # 如果有，那么调用fetchmany方法获取mysql返回的数据
@@ -77,32 +520,94 @@ async def select(sql, args, size=None):
             rs = await cur.fetchall()
         # 关闭角标
         await cur.close()
-        logging.info('rows returned: %s' % len(rs))
+        metrics.observe_sql(sql, time.perf_counter() - start, len(rs))
+        _sql_log.info('rows returned: %s', len(rs))
         return rs
 
+
+async def select(sql, args, size=None):
+    return await _select(_translate(sql), args, size)
+
 # 再定义函数完成 Insert, Updata, Delete操作
 # 因为这三个操作在Mysql语句下传入的参数相同，返回的内容也类似，因此
 # 可以用一个函数实现
 
 
-@asyncio.coroutine
-async def execute(sql, args):
-    logging.info(sql)
-    global __pool
+async def _execute(sql, args):
+    _sql_log.info('SQL: %s, args: %s', sql, args)
+    _mark_write()
     # 从连接池中继续
-    with (await __pool) as conn:
+    async with _connection() as conn:
         try:
             # 提取角标，因为返回的内容不是数据，所以不用返回字典
             cur = await conn.cursor()
+            start = time.perf_counter()
             # 执行sql语句
-            await cur.execute(sql.replace('?', '%s'), args)
+            await cur.execute(sql, args)
             # rowcount属性是sql语句返回的行数，即受影响的行数
             affected = cur.rowcount
             await cur.close()
+            metrics.observe_sql(sql, time.perf_counter() - start, affected)
         except BaseException as e:
             raise
         return affected
 
+
+async def execute(sql, args):
+    return await _execute(_translate(sql), args)
+
+# 批量执行同一条语句，args_list 中每一项是一行的参数
+# 整个批次只占用一次连接，用于 Model.update_all 这类逐行语句相同的操作
+
+
+async def _executemany(sql, args_list):
+    _sql_log.info('SQL: %s (x%s)', sql, len(args_list))
+    _mark_write()
+    async with _connection() as conn:
+        cur = await conn.cursor()
+        start = time.perf_counter()
+        await cur.executemany(sql, args_list)
+        affected = cur.rowcount
+        await cur.close()
+        metrics.observe_sql(sql, time.perf_counter() - start, affected)
+        return affected
+
+
+async def executemany(sql, args_list):
+    return await _executemany(_translate(sql), args_list)
+
+# 流式查询，用于导出整张表这类结果很大的查询
+# aiomysql.SSDictCursor 是服务端游标，数据在 fetch 时才从mysql传过来
+# 每次 fetchmany(batch_size) 取一批并 yield 出去，内存中同时只有一批数据
+# 用法：async for rs in orm.select_stream(sql, args): ...
+# 注意：迭代结束前连接一直被占用，事务中不要在迭代过程中执行其他语句
+
+
+async def _select_stream(sql, args, batch_size=500, shard=None):
+    _sql_log.info('SQL: %s, args: %s', sql, args)
+    async with _connection(readonly=True, shard=shard) as conn:
+        cur = await conn.cursor(_backend.stream_cursor)
+        # 流式查询的耗时包括调用方处理每一批的时间
+        start = time.perf_counter()
+        rows = 0
+        try:
+            await cur.execute(sql, args or ())
+            while True:
+                rs = await cur.fetchmany(batch_size)
+                if not rs:
+                    break
+                rows += len(rs)
+                yield rs
+        finally:
+            # 提前 break 时，close 会读完并丢弃剩下的数据
+            await cur.close()
+            metrics.observe_sql(sql, time.perf_counter() - start, rows)
+
+
+async def select_stream(sql, args, batch_size=500):
+    async for rs in _select_stream(_translate(sql), args, batch_size):
+        yield rs
+
 # 有了基本函数了，开始编写ORM
 # ORM （object/Relational Mapping）
 # 所实现的是 对象-关系映射，即数据库中的一行=一个对象，一个类对应一个表
@@ -128,7 +633,7 @@ async def execute(sql, args):
 
 class Field(object):
 
-    def __init__(self, name, column_type, primary_key, default):
+    def __init__(self, name, column_type, primary_key, default, lazy=False):
         # 列名
         self.name = name
         # 列的属性
@@ -137,6 +642,8 @@ class Field(object):
         self.primary_key = primary_key
         # 该列的默认值是什么
         self.default = default
+        # 是否延迟加载：默认的查询不取这一列，需要时用 Model.load_deferred 批量加载
+        self.lazy = lazy
 
     def __str__(self):
         return '<%s, %s:%s>' % (self.__class__.__name__, self.column_type, self.name)
@@ -159,8 +666,32 @@ class FloatField(Field):
 
 class TextField(Field):
 
-    def __init__(self, name=None, default=None):
-        super().__init__(name, 'text', False, default)
+    def __init__(self, name=None, default=None, lazy=False):
+        super().__init__(name, 'text', False, default, lazy)
+
+# 关联关系，只用于 prefetch 批量加载，不会自动查询
+# class Comment(Model):
+#     blog_id = StringField(ddl='varchar(50)')
+#     blog = Relation('Blog', 'blog_id')                  # 多对一：comment.blog
+# class Blog(Model):
+#     comments = Relation('Comment', 'blog_id', many=True)  # 一对多：blog.comments
+# model 可以是 Model 类，也可以是类名（字符串），以便引用在后面才定义的类
+
+class Relation(object):
+
+    def __init__(self, model, key, many=False):
+        self.model = model
+        # many=False 时 key 是本表中的外键列；many=True 时 key 是对方表中指向本表主键的列
+        self.key = key
+        self.many = many
+
+    def target(self):
+        if isinstance(self.model, str):
+            return _models[self.model]
+        return self.model
+
+# 所有已定义的 Model，类名 => 类，用于解析 Relation 中的类名
+_models = dict()
 
 # 要实现上述的调用形式
 # 首先，先定义元类，类似于类的类
@@ -212,34 +743,179 @@ class ModelMetaclass(type):
                 else:
                     # 非主键列，增加到field列表
                     fields.append(k)
+        relations = dict((k, v) for k, v in attrs.items() if isinstance(v, Relation))
         # 映射完后，如果还没有设置主键，报错
         if not primaryKey:
             raise RuntimeError('Primary key not found.')
         # 添加完映射后，从attrs这个字典中删除已经添加的。后续会构建新的内容
         for k in mappings.keys():
             attrs.pop(k)
+        for k in relations.keys():
+            attrs.pop(k)
         escaped_fields = list(map(lambda f: '`%s`' % f, fields))
         attrs['__mappings__'] = mappings  # 保存属性和列的映射关系
         attrs['__table__'] = tableName
         attrs['__primary_key__'] = primaryKey  # 主键属性名
         attrs['__fields__'] = fields  # 除主键外的属性名
+        attrs['__relations__'] = relations  # 关联关系
+        attrs['__lazy__'] = [f for f in fields if mappings[f].lazy]  # 延迟加载的属性名
         # 构造默认的SELECT, INSERT, UPDATE和DELETE语句:
-        attrs['__select__'] = 'select `%s`, %s from `%s`' % (
-            primaryKey, ', '.join(escaped_fields), tableName)
+        # 默认的SELECT不包含延迟加载的列
+        attrs['__select__'] = _select_columns_sql(
+            tableName, primaryKey, [f for f in fields if not mappings[f].lazy])
         # mysql的插入语句 INSERT INTO 表名(列名) VALUES(每一列的值都必须提供，NULL也需要)
         attrs['__insert__'] = 'insert into `%s` (%s, `%s`) values (%s)' % (tableName, ', '.join(
             escaped_fields), primaryKey, create_args_string(len(escaped_fields) + 1))
+        # 多行插入时，每多一行就在 __insert__ 后面追加一组 (?, ?, ...)
+        attrs['__insert_row__'] = '(%s)' % create_args_string(len(escaped_fields) + 1)
         attrs['__update__'] = 'update `%s` set %s where `%s`=?' % (tableName, ', '.join(
             map(lambda f: '`%s`=?' % (mappings.get(f).name or f), fields)), primaryKey)
         attrs['__delete__'] = 'delete from `%s` where `%s`=?' % (
             tableName, primaryKey)
-        return type.__new__(cls, name, bases, attrs)
+        # 预先把上面的语句转换成mysql的%s占位符，执行时不用再replace
+        attrs['__prepared__'] = dict(
+            select=_translate(attrs['__select__']),
+            find=_translate('%s where `%s`=?' % (attrs['__select__'], primaryKey)),
+            insert=_translate(attrs['__insert__']),
+            insert_row=_translate(attrs['__insert_row__']),
+            update=_translate(attrs['__update__']),
+            delete=_translate(attrs['__delete__']))
+        model = type.__new__(cls, name, bases, attrs)
+        # 为每个 Model 生成对应的紧凑行类，见下面的 Row
+        model.__row__ = type('%sRow' % name, (Row,), dict(
+            __slots__=tuple([primaryKey] + fields + list(relations)), __model__=model))
+        _models[name] = model
+        return model
+
+def _select_columns_sql(table, primaryKey, columns):
+    return 'select %s from `%s`' % (', '.join(map(lambda f: '`%s`' % f, [primaryKey] + list(columns))), table)
+
+# 建表语句，本地测试（sqlite 内存数据库）、分片测试和 bench.py 用来创建空表
+
+
+def create_table_sql(cls):
+    columns = ['`%s` %s not null' % (k, f.column_type) for k, f in cls.__mappings__.items()]
+    return 'create table if not exists `%s` (%s, primary key (`%s`))' % (
+        cls.__table__, ', '.join(columns), cls.__primary_key__)
+
+# 列投影：查询时只取部分列
+# fields 指定要取的列（主键总是会取），defer 指定不取的列，都不传时使用默认的 __select__
+# 没有取出的列在对象上不存在（访问时 AttributeError），update() 也不会写这些列
+
+
+def _projection_sql(cls, fields=None, defer=None):
+    if fields is None and defer is None:
+        return cls.__select__
+    key = (cls, 'select', None if fields is None else tuple(fields), None if defer is None else tuple(defer))
+    sql = _sql_cache.get(key)
+    if sql is None:
+        for f in list(fields or ()) + list(defer or ()):
+            if f not in cls.__mappings__:
+                raise ValueError('Invalid field: %s' % f)
+        if fields is None:
+            columns = [f for f in cls.__fields__ if f not in cls.__lazy__]
+        else:
+            columns = [f for f in cls.__fields__ if f in fields]
+        columns = [f for f in columns if f not in (defer or ())]
+        sql = _select_columns_sql(cls.__table__, cls.__primary_key__, columns)
+        _sql_cache.put(key, sql)
+    return sql
+
+# findAll / iterate 共用：拼出（或从缓存中取出）查询语句，返回 (sql, args)
+
+
+def _find_all_sql(cls, where, args, orderBy=None, limit=None, select=None):
+    # args 会在后面追加 limit 参数，复制一份，避免修改调用方传入的列表
+    args = list(args) if args else []
+    # sql 语句可以传入order by ... 来指示返回的数据根据什么排列
+    # sql 可以传入limit参数，限制返回的数据行数
+    # 如果是limit N 则返回N条数据
+    # 如果是limit N, M 则从N开始，返回M条数据
+    if limit is None:
+        shape = None
+    # 首先判断limit是N 还是N，M
+    elif isinstance(limit, int):
+        # ? 会被转换为%s 然后被args中的参数填充替换
+        shape = '?'
+        args.append(limit)
+    # 如果是元祖，且有两个字符，那就是N，M
+    elif isinstance(limit, tuple) and len(limit) == 2:
+        shape = '?, ?'
+        # extend 把 limit 加到末尾
+        args.extend(limit)
+    else:
+        # 不行就报错
+        raise ValueError('Invalid limit value: %s' % str(limit))
+    select = select or cls.__select__
+    # 同样的 select/where/orderBy/limit 形状拼出的语句总是相同的，直接从缓存中取
+    key = (cls, select, where, orderBy, shape)
+    sql = _sql_cache.get(key)
+    if sql is None:
+        # mysql中根据WHERE条件进行查询的语句是
+        # SELECT field1 FROM tablename WHERE condition1
+        # 实际上只是在基础的select语句的后面，加上了WHERE condition
+        L = [select]
+        if where:
+            L.append('where')
+            L.append(where)
+        if orderBy:
+            L.append('order by')
+            L.append(orderBy)
+        if shape:
+            L.append('limit')
+            L.append(shape)
+        sql = _translate(' '.join(L))
+        _sql_cache.put(key, sql)
+    return sql, args
+
+# 分页游标（continuation token）：上一页最后一行的 (排序列, 排序值, 主键)
+# 编码成不透明的字符串交给客户端，下一页请求时原样带回
+
+
+def encode_cursor(orderBy, value, pk):
+    data = json.dumps([orderBy, value, pk], separators=(',', ':'))
+    return base64.urlsafe_b64encode(data.encode('utf-8')).decode('ascii').rstrip('=')
+
+
+class CursorError(ValueError):
+    ' raised for a malformed page cursor, or one that does not match the query. '
+    pass
+
+
+# 游标中只能是标量值，列表、字典等不会传进 SQL
+_CURSOR_TYPES = (str, int, float)
+
+
+def decode_cursor(token):
+    ' return (order column, value, primary key), raise CursorError if the token is malformed. '
+    try:
+        data = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4))
+        orderBy, value, pk = json.loads(data.decode('utf-8'))
+    except (ValueError, TypeError):
+        raise CursorError('Invalid cursor: %s' % token)
+    if not isinstance(orderBy, str) or not isinstance(value, _CURSOR_TYPES) or not isinstance(pk, _CURSOR_TYPES):
+        raise CursorError('Invalid cursor: %s' % token)
+    return orderBy, value, pk
 
 # 定义所有映射的基类 model:
 # 之后新建立的数据都是以这个类为基础建立
 # 实际上就是一个字典，只是在字典的基础上，多了两个功能
 class Model(dict, metaclass=ModelMetaclass):
 
+    # save_all / update_all 每个批次最多包含的行数，子类可以覆盖
+    __batch_size__ = 500
+    # 查询结果缓存的有效期（秒），None 表示不缓存
+    __cache_ttl__ = None
+    # 为 True 时查询默认返回紧凑的 Row 对象而不是 Model，也可以每次查询传入 compact=True/False
+    __compact__ = False
+    # 分片：__shards__ 是 db 配置中 shards 的组名，__shard_key__ 是分片键的列名
+    # 一行保存在第 __shard_fn__(分片键的值, 分片数) 个分片上，默认按 crc32 取模
+    # find/findAll/findPage/findNumber 的 where 中有 `分片键`=? 时只查询一个分片，否则查询所有分片再合并
+    # save 时必须有分片键；跨分片的 iterate 逐个分片返回，orderBy 只在分片内有效
+    __shards__ = None
+    __shard_key__ = None
+    __shard_fn__ = staticmethod(shard_hash)
+
     def __init__(self, **kw):
         # super函数用于继承字典的所有方法
         super(Model, self).__init__(**kw)
@@ -264,8 +940,7 @@ class Model(dict, metaclass=ModelMetaclass):
             field = self.__mappings__[key]
             if field.default is not None:
                 value = field.default() if callable(field.default) else field.default
-                logging.debug('using default value for %s: %s' %
-                              (key, str(value)))
+                logging.debug('using default value for %s: %s', key, value)
                 setattr(self, key, value)
         return value
 
@@ -273,12 +948,17 @@ class Model(dict, metaclass=ModelMetaclass):
     # 见https://blog.csdn.net/handsomekang/article/details/9615239
     # 实现 User.find('xx')
     @classmethod
-    async def find(cls, pk):
+    async def find(cls, pk, compact=None, fields=None, defer=None):
         ' find object by primary key. '
-        rs = await select('%s where `%s`=?' % (cls.__select__, cls.__primary_key__), [pk], 1)
+        if fields is None and defer is None:
+            sql = cls.__prepared__['find']
+        else:
+            sql, _ = _find_all_sql(cls, '`%s`=?' % cls.__primary_key__, None,
+                                   select=_projection_sql(cls, fields, defer))
+        rs = await _cached_select(cls, sql, [pk], 1, where='`%s`=?' % cls.__primary_key__)
         if len(rs) == 0:
             return None
-        return cls(**rs[0])
+        return _row_class(cls, compact)(**rs[0])
     # 实现FindAll方法，用于查询
     # 使用方法为User.findAll()
     # 相当于在整个表中进行查询
@@ -286,50 +966,69 @@ class Model(dict, metaclass=ModelMetaclass):
     # 除了where和args，还可以输入limit，orderBy
     @classmethod
     async def findAll(cls, where=None, args=None, **kw):
-        # mysql中根据WHERE条件进行查询的语句是
-        # SELECT field1 FROM tablename WHERE condition1
-        # 实际上只是在基础的select语句的后面，加上了WHERE condition
-        sql = [cls.__select__]
-        # 首先判断是否输入了where参数
-        if where:
-            # 先添加where关键字
-            sql.append('where')
-            # 在添加具体的条件
-            sql.append(where)
-        if args is None:
-            # args参数的作用是什么还不清楚
-            args = []
-        # sql 语句可以传入order by ... 来指示返回的数据根据什么排列
-        # 先判断调用findAll方法时是否有传入这个参数
-        # kw.get方法 用于提取**kw参数
-        orderBy = kw.get('orderBy', None)
-        if orderBy:
-            sql.append('order by')
-            sql.append(orderBy)
-        # sql 可以传入limit参数，限制返回的数据行数
-        # 如果是limit N 则返回N条数据
-        # 如果是limit N, M 则从N开始，返回M条数据
-        limit = kw.get('limit', None)
-        if limit is not None:
-            sql.append('limit')
-            # 首先判断limit是N 还是N，M
-            if isinstance(limit, int):
-                # 如果 limit 为整数
-                # ? 会被转换为%s 然后被args中的参数填充替换
-                sql.append('?')
-                args.append(limit)
-            # 如果是元祖，且有两个字符，那就是N，M
-            elif isinstance(limit, tuple) and len(limit) == 2:
-                # 如果 limit 是元组且里面只有两个元素
-                sql.append('?, ?')
-                # extend 把 limit 加到末尾
-                args.extend(limit)
-            else:
-                # 不行就报错
-                raise ValueError('Invalid limit value: %s' % str(limit))
-        rs = await select(' '.join(sql), args)
-        print('rs is %s' % [cls(**r) for r in rs])
-        return [cls(**r) for r in rs]
+        sql, args = _find_all_sql(cls, where, args, kw.get('orderBy', None), kw.get('limit', None),
+                                  _projection_sql(cls, kw.get('fields', None), kw.get('defer', None)))
+        rs = await _cached_select(cls, sql, args, where=where, orderBy=kw.get('orderBy', None),
+                                  limit=kw.get('limit', None))
+        make = _row_class(cls, kw.get('compact', None))
+        models = [make(**r) for r in rs]
+        if kw.get('prefetch', None):
+            await prefetch(models, *kw['prefetch'])
+        return models
+
+    # 基于游标（keyset）的分页，代替 limit=(offset, n)
+    # offset 越大 mysql 需要跳过的行越多，而游标分页直接从上一页最后一行之后开始，每页的代价相同
+    # 按 orderBy 列排序，主键作为相同值时的第二排序列，保证翻页时不重复也不遗漏
+    # 返回 (本页的对象列表, 下一页的游标)，没有下一页时游标为 None
+    # blogs, cursor = await Blog.findPage(limit=10)
+    # blogs, cursor = await Blog.findPage(limit=10, cursor=cursor)
+    @classmethod
+    async def findPage(cls, where=None, args=None, orderBy='created_at', desc=True, limit=10, cursor=None, compact=None, fields=None, defer=None):
+        ' find one page ordered by (orderBy, primary key), return (models, next cursor). '
+        if orderBy not in cls.__mappings__:
+            raise ValueError('Invalid order by field: %s' % orderBy)
+        pk = cls.__primary_key__
+        args = list(args) if args else []
+        conds = ['(%s)' % where] if where else []
+        if cursor is not None:
+            if isinstance(cursor, str):
+                cursor = decode_cursor(cursor)
+            column, value, last = cursor
+            if column != orderBy:
+                raise CursorError('Cursor is not ordered by %s' % orderBy)
+            op = '<' if desc else '>'
+            conds.append('(`%s` %s ? or (`%s` = ? and `%s` %s ?))' % (orderBy, op, orderBy, pk, op))
+            args.extend([value, value, last])
+        direction = 'desc' if desc else 'asc'
+        order = '`%s` %s, `%s` %s' % (orderBy, direction, pk, direction)
+        # 多取一行，用来判断是否还有下一页
+        sql, args = _find_all_sql(cls, ' and '.join(conds) or None, args, order, limit + 1,
+                                  _projection_sql(cls, fields, defer))
+        # 分片按调用者的 where 选择：游标条件中有 or，而调用者的参数在前面，分片键的位置不变
+        rs = await _cached_select(cls, sql, args, where=where, orderBy=order, limit=limit + 1)
+        make = _row_class(cls, compact)
+        models = [make(**r) for r in rs[:limit]]
+        if len(rs) <= limit:
+            return models, None
+        last = models[-1]
+        return models, encode_cursor(orderBy, last.getValue(orderBy), last.getValue(pk))
+
+    # 和 findAll 参数相同，但不一次性取出全部结果，而是边读边返回
+    # async for comment in Comment.iterate(orderBy='created_at'): ...
+    # chunks=True 时每次返回一批（list），而不是单个对象
+    @classmethod
+    async def iterate(cls, where=None, args=None, batch_size=None, chunks=False, **kw):
+        ' iterate over matching rows through a server-side cursor. '
+        sql, args = _find_all_sql(cls, where, args, kw.get('orderBy', None), kw.get('limit', None),
+                                  _projection_sql(cls, kw.get('fields', None), kw.get('defer', None)))
+        make = _row_class(cls, kw.get('compact', None))
+        for shard in _shard_names(cls, where, args) or [None]:
+            async for rs in _select_stream(sql, args, batch_size or cls.__batch_size__, shard):
+                if chunks:
+                    yield [make(**r) for r in rs]
+                else:
+                    for r in rs:
+                        yield make(**r)
 
     # 再实现findNumber方法。这个方法的目的是实现SQL语句 select count(*)
     # 该语句返回指定列的值的数目，例如查看id这一列，有多少行，则返回多少
@@ -340,11 +1039,21 @@ class Model(dict, metaclass=ModelMetaclass):
     async def findNumber(cls, selectField, where=None, args=None):
         ## find number by select and where
         #找到选中的数及其位置
-        sql = ['select %s _num_ from `%s`' % (selectField, cls.__table__)]
-        if where:
-            sql.append('where')
-            sql.append(where)
-        rs = await select(' '.join(sql), args, size=1)
+        key = (cls, 'number', selectField, where)
+        sql = _sql_cache.get(key)
+        if sql is None:
+            L = ['select %s _num_ from `%s`' % (selectField, cls.__table__)]
+            if where:
+                L.append('where')
+                L.append(where)
+            sql = _translate(' '.join(L))
+            _sql_cache.put(key, sql)
+        names = _shard_names(cls, where, args)
+        if names is not None and len(names) > 1:
+            # 所有分片的结果按聚合函数合并：count/sum 相加，max/min 取最大/最小
+            results = await asyncio.gather(*[_run_on(n, _cached_select_one, cls, sql, args, 1) for n in names])
+            return _combine(selectField, [rs[0]['_num_'] for rs in results if rs])
+        rs = await _cached_select(cls, sql, args, size=1, where=where)
         if len(rs) == 0:
             # 如果 rs 内无元素，返回 None ；有元素就返回某个数
             return None
@@ -357,23 +1066,317 @@ class Model(dict, metaclass=ModelMetaclass):
         args = list(map(self.getValueOrDefault, self.__fields__))
         # 提取这一行 主键列的值
         args.append(self.getValueOrDefault(self.__primary_key__))
+        names = _write_shards(self)
+        if names is not None and len(names) > 1:
+            raise ValueError('Missing shard key: %s' % self.__shard_key__)
         # 执行execute函数中的insert方法
-        rows = await execute(self.__insert__, args)
+        rows = await _execute_on(names, self.__prepared__['insert'], args)
+        await _invalidate(self.__table__)
         # 一般情况都是添加新的一行。返回行数1
         if rows != 1:
             logging.warn('failed to insert record: affected rows: %s' % rows)
 
     async def update(self):
-        args = list(map(self.getValue, self.__fields__))
+        # 只更新对象上存在的列，延迟加载或投影时没有取出的列保持数据库中的原值
+        columns = _loaded_fields(self)
+        if not columns:
+            return
+        args = list(map(self.getValue, columns))
         args.append(self.getValue(self.__primary_key__))
-        rows = await execute(self.__update__, args)
+        rows = await _execute_on(_write_shards(self), _update_sql(self, columns), args)
+        await _invalidate(self.__table__)
         if rows != 1:
             logging.warning(
                 'failed to update by primary key: affected rows: %s' % rows)
 
     async def remove(self):
         args = [self.getValue(self.__primary_key__)]
-        rows = await execute(self.__delete__, args)
+        rows = await _execute_on(_write_shards(self), self.__prepared__['delete'], args)
+        await _invalidate(self.__table__)
         if rows != 1:
             logging.warning(
                 'failed to remove by primary key: affected rows: %s' % rows)
+
+    # 批量写入：导入评论、回填博客时一次写入成千上万行
+    # 逐行 save() 每行都要取一次连接、走一次网络往返，这里按批次合并
+    @classmethod
+    async def save_all(cls, rows, batch_size=None):
+        ' insert rows with one multi-row insert per batch, return affected rows of each batch. '
+        # Model 和紧凑的 Row 对象都直接使用，其余的（例如字典）转换成 Model
+        rows = [r if isinstance(r, (cls, cls.__row__)) else cls(**r) for r in rows]
+        batch_size = batch_size or cls.__batch_size__
+        if cls.__shard_key__:
+            for r in rows:
+                r.getValueOrDefault(cls.__shard_key__)
+        # 分片模型按分片分组，各分片并发写入
+        groups = _group_by_shard(cls, rows, insert=True)
+        results = await asyncio.gather(*[_run_on(name, _insert_batches, cls, part, batch_size)
+                                         for name, part in groups.items()])
+        await _invalidate(cls.__table__)
+        return [n for counts in results for n in counts]
+
+    @classmethod
+    async def update_all(cls, rows, batch_size=None):
+        ' update rows by primary key with executemany per batch, return affected rows of each batch. '
+        # Model 和紧凑的 Row 对象都直接使用，其余的（例如字典）转换成 Model
+        rows = [r if isinstance(r, (cls, cls.__row__)) else cls(**r) for r in rows]
+        batch_size = batch_size or cls.__batch_size__
+        groups = _group_by_shard(cls, rows)
+        results = await asyncio.gather(*[_run_on(name, _update_batches, cls, part, batch_size)
+                                         for name, part in groups.items()])
+        await _invalidate(cls.__table__)
+        return [n for counts in results for n in counts]
+
+    # 批量加载延迟加载（或投影时没有取出）的列，每 __batch_size__ 个对象一条 where `id` in (...) 查询
+    # blogs = await Blog.findAll()
+    # await Blog.load_deferred(blogs)        # 加载所有缺少的列
+    # await Blog.load_deferred(blogs, ['content'])
+    # 属性访问是同步的，无法在第一次访问时再去查询数据库，所以需要显式调用
+    @classmethod
+    async def load_deferred(cls, models, fields=None):
+        ' load missing columns of models with one batched query per chunk. '
+        pk = cls.__primary_key__
+        if fields is None:
+            fields = [f for f in cls.__fields__ if any(_missing(m, f) for m in models)]
+        if not fields or not models:
+            return models
+        batch_size = cls.__batch_size__
+        for i in range(0, len(models), batch_size):
+            batch = dict((m.getValue(pk), m) for m in models[i:i + batch_size])
+            where = '`%s` in (%s)' % (pk, create_args_string(len(batch)))
+            sql, args = _find_all_sql(cls, where, list(batch), select=_projection_sql(cls, fields))
+            for r in await _cached_select(cls, sql, args, where=where):
+                m = batch.get(r[pk])
+                if m is not None:
+                    for f in fields:
+                        setattr(m, f, r[f])
+        return models
+
+# save_all / update_all 在一个连接池（分片）上分批执行
+
+
+async def _insert_batches(cls, rows, batch_size):
+    counts = []
+    for i in range(0, len(rows), batch_size):
+        batch = rows[i:i + batch_size]
+        args = []
+        for r in batch:
+            args.extend(map(r.getValueOrDefault, cls.__fields__))
+            args.append(r.getValueOrDefault(cls.__primary_key__))
+        # insert into `t` (...) values (?, ?), (?, ?), ...
+        prepared = cls.__prepared__
+        sql = ', '.join([prepared['insert']] + [prepared['insert_row']] * (len(batch) - 1))
+        affected = await _execute(sql, args)
+        if affected != len(batch):
+            logging.warning('failed to insert records: affected rows: %s of %s' % (affected, len(batch)))
+        counts.append(affected)
+    return counts
+
+
+async def _update_batches(cls, rows, batch_size):
+    counts = []
+    for i in range(0, len(rows), batch_size):
+        # 和 update() 一样只更新存在的列，列相同的行放在同一次 executemany 中
+        groups = dict()
+        for r in rows[i:i + batch_size]:
+            columns = _loaded_fields(r)
+            args = list(map(r.getValue, columns))
+            args.append(r.getValue(cls.__primary_key__))
+            groups.setdefault(columns, []).append(args)
+        affected = 0
+        for columns, args_list in groups.items():
+            affected += await _executemany(_update_sql(cls, columns), args_list)
+        counts.append(affected)
+    return counts
+
+
+def _group_by_shard(cls, rows, insert=False):
+    ' split rows by the pool they are written to, {None: rows} when cls is not sharded. '
+    if not cls.__shards__ or not _shards.get(cls.__shards__):
+        return {None: rows}
+    groups = dict()
+    for r in rows:
+        names = _write_shards(r)
+        if insert and len(names) > 1:
+            raise ValueError('Missing shard key: %s' % cls.__shard_key__)
+        for name in names:
+            groups.setdefault(name, []).append(r)
+    return groups
+
+# 紧凑的行对象
+# Model 继承自 dict，每一行都是一个完整的字典，属性访问还要经过 Python 层的 __getattr__
+# ModelMetaclass 为每个 Model 生成一个 Row 的子类（例如 User.__row__ 就是 UserRow），
+# 只用 __slots__ 保存各列的值，没有 __dict__，占用的内存更少，属性访问由 slot 直接完成
+# 查询时传入 compact=True（或在 Model 上设置 __compact__ = True）得到这种对象
+# save/update/remove 等方法直接复用 Model 的实现
+
+
+class Row(object):
+
+    __slots__ = ()
+
+    def __init__(self, **kw):
+        for k, v in kw.items():
+            setattr(self, k, v)
+
+    def __getattr__(self, key):
+        # 只有正常查找失败时才会调用这里
+        # __table__、__fields__ 这类元数据从对应的 Model 上取
+        if key.startswith('__') and key.endswith('__') and key != '__model__':
+            return getattr(self.__model__, key)
+        # 没有赋值的列和 Model 一样抛出 AttributeError
+        raise AttributeError(r"'%s' object has no attribute '%s'" % (self.__class__.__name__, key))
+
+    def __repr__(self):
+        return '<%s %s>' % (self.__class__.__name__, dict(self.items()))
+
+    def items(self):
+        # 已经赋值的列，用于转换成 dict / JSON
+        for k in self.__slots__:
+            try:
+                yield k, getattr(self, k)
+            except AttributeError:
+                pass
+
+    getValue = Model.getValue
+    getValueOrDefault = Model.getValueOrDefault
+    save = Model.save
+    update = Model.update
+    remove = Model.remove
+
+
+_MISSING = object()
+
+
+def _missing(obj, key):
+    return getattr(obj, key, _MISSING) is _MISSING
+
+
+def _loaded_fields(obj):
+    return tuple(f for f in obj.__fields__ if not _missing(obj, f))
+
+# 更新部分列的语句，列齐全时直接用预先转换好的 __update__
+
+
+def _update_sql(obj, columns):
+    if len(columns) == len(obj.__fields__):
+        return obj.__prepared__['update']
+    key = (obj.__table__, 'update', columns)
+    sql = _sql_cache.get(key)
+    if sql is None:
+        mappings = obj.__mappings__
+        sql = _translate('update `%s` set %s where `%s`=?' % (obj.__table__, ', '.join(
+            map(lambda f: '`%s`=?' % (mappings.get(f).name or f), columns)), obj.__primary_key__))
+        _sql_cache.put(key, sql)
+    return sql
+
+
+def _row_class(cls, compact):
+    if compact is None:
+        compact = cls.__compact__
+    return cls.__row__ if compact else cls
+
+# 批量加载关联对象，解决 N+1 查询
+# 例如显示一篇博客的所有评论及评论者，逐条 User.find() 会产生 N 次查询；
+# prefetch 对每个关联只执行一条 where `id` in (...) 查询（超过 __batch_size__ 时分批）
+# comments = await Comment.findAll('blog_id=?', [blog.id], prefetch=['user'])
+# await orm.prefetch(comments, 'user', 'blog')
+# 加载的对象登记在身份映射（identity map）中，同一行在一个 identity_map() 范围内只构造一次；
+# coroweb.RequestHandler 为每个请求开启一个范围，不在范围内时每次 prefetch 单独使用一个
+_identity = contextvars.ContextVar('identity', default=None)
+
+
+@contextmanager
+def identity_map():
+    token = _identity.set(dict())
+    try:
+        yield
+    finally:
+        _identity.reset(token)
+
+
+async def _find_in(cls, key, values, identity):
+    # 查询 key 列在 values 中的行，已经在 identity 中的行直接复用
+    pk = cls.__primary_key__
+    make = _row_class(cls, None)
+    result = []
+    values = list(values)
+    for i in range(0, len(values), cls.__batch_size__):
+        batch = values[i:i + cls.__batch_size__]
+        where = '`%s` in (%s)' % (key, create_args_string(len(batch)))
+        sql, args = _find_all_sql(cls, where, batch)
+        for r in await _cached_select(cls, sql, args, where=where):
+            ident = (cls.__table__, r[pk])
+            obj = identity.get(ident)
+            if obj is None:
+                obj = identity[ident] = make(**r)
+            result.append(obj)
+    return result
+
+
+def _inverse(cls, rel):
+    ' name of the relation on the target model pointing back to cls through the same key. '
+    target = rel.target()
+    for name, r in target.__relations__.items():
+        if r.key == rel.key and r.many != rel.many and r.target() is cls:
+            return name
+    return None
+
+
+def _unset(obj, name):
+    if isinstance(obj, dict):
+        obj.pop(name, None)
+    elif not _missing(obj, name):
+        delattr(obj, name)
+
+# 同一个对象在 identity map 中只有一份，两个方向都 prefetch（blog.comments 和 comment.blog）时
+# 会形成环，JSON 编码时无限递归；约定一对多的一侧优先：
+# 父对象上挂了子对象列表时，子对象上不再保留指回父对象的引用
+
+
+async def prefetch(models, *names):
+    ' resolve relations of models with one "in" query per relation and attach the results. '
+    if not models:
+        return models
+    identity = _identity.get()
+    if identity is None:
+        identity = dict()
+    relations = models[0].__relations__
+    pk = models[0].__primary_key__
+    table = models[0].__table__
+    cls = getattr(models[0], '__model__', type(models[0]))
+    for m in models:
+        identity.setdefault((table, m.getValue(pk)), m)
+    for name in names:
+        if name not in relations:
+            raise ValueError('Invalid relation: %s' % name)
+        rel = relations[name]
+        target = rel.target()
+        inverse = _inverse(cls, rel)
+        if rel.many:
+            # 一对多：对方表的 key 列等于本表主键
+            keys = dict.fromkeys(m.getValue(pk) for m in models)
+            groups = dict()
+            for obj in await _find_in(target, rel.key, keys, identity):
+                groups.setdefault(obj.getValue(rel.key), []).append(obj)
+            for m in models:
+                children = groups.get(m.getValue(pk), [])
+                if inverse is not None:
+                    for obj in children:
+                        if getattr(obj, inverse, None) is m:
+                            _unset(obj, inverse)
+                setattr(m, name, children)
+        else:
+            # 多对一：本表的 key 列等于对方表主键，已经加载过的不再查询
+            ident = target.__table__
+            keys = dict.fromkeys(m.getValue(rel.key) for m in models)
+            keys = [k for k in keys if k is not None and (ident, k) not in identity]
+            if keys:
+                await _find_in(target, target.__primary_key__, keys, identity)
+            for m in models:
+                parent = identity.get((ident, m.getValue(rel.key)))
+                if inverse is not None and parent is not None and any(
+                        obj is m for obj in getattr(parent, inverse, None) or ()):
+                    continue
+                setattr(m, name, parent)
+    return models
@@ -0,0 +1,243 @@
+# -*- encoding: utf-8 -*-
+'''
+@File    :   pool.py
+@Time    :   2026/10/19 09:20:41
+'''
+
+# here put the import lib
+# 数据库连接池，orm.create_pool 创建，替代 aiomysql 自带的连接池
+# 1. 预热：启动时并发打开 minsize 个连接，第一批请求不用等建立连接
+# 2. 回收：连接打开超过 recycle 秒就关闭重建，避免被 mysql 的 wait_timeout 断开；
+#    空闲超过 ping_interval 秒的连接借出前先 ping 一次，断开的直接丢弃
+# 3. 超时：等待空闲连接超过 acquire_timeout 秒抛出 PoolTimeout，RequestHandler 返回 503，
+#    请求突增时不会在连接池上无限排队
+# 4. 自适应（adaptive=True）：按借连接的平均等待时间调整 maxsize，
+#    等待超过 adaptive_wait 时增大（最多到 adaptive_maxsize），几乎不用等待时逐步缩小（最少到 minsize）
+# 连接只需要提供 ping()（协程）、close()（可以返回协程）和 closed 属性，由 connect 函数创建
+
+import time
+import asyncio
+import inspect
+import logging
+from collections import deque
+logging.basicConfig(level=logging.INFO)
+
+
+class PoolTimeout(Exception):
+    ' no connection became available within acquire_timeout. '
+    pass
+
+
+class Pool(object):
+    '''
+    a connection pool with warm-up, recycling, acquire timeout and optional adaptive sizing.
+    '''
+
+    def __init__(self, connect, minsize=1, maxsize=10, recycle=3600, ping_interval=30,
+                 acquire_timeout=5, adaptive=False, adaptive_maxsize=50, adaptive_wait=0.005,
+                 adaptive_interval=1.0):
+        self._connect = connect
+        self.minsize = minsize
+        self.maxsize = max(maxsize, minsize)
+        self.recycle = recycle
+        self.ping_interval = ping_interval
+        self.acquire_timeout = acquire_timeout
+        self.adaptive = adaptive
+        self.adaptive_maxsize = max(adaptive_maxsize, self.maxsize)
+        self.adaptive_wait = adaptive_wait
+        self.adaptive_interval = adaptive_interval
+        # 空闲连接：(conn, 打开的时间, 归还的时间)，右进右出，最近用过的先借出
+        self._free = deque()
+        # 借出的连接 => 打开的时间
+        self._used = dict()
+        # 已经打开和正在打开的连接数
+        self._size = 0
+        # 等待连接的 future，归还时直接把连接交给最早的一个；结果为 None 表示可以重新尝试
+        self._waiters = deque()
+        self._closing = False
+        # 借连接等待时间的指数移动平均
+        self.wait = 0.0
+        self._adjusted = time.monotonic()
+        # 还没有完成的异步 close()
+        self._closers = set()
+
+    @property
+    def size(self):
+        return self._size
+
+    @property
+    def freesize(self):
+        return len(self._free)
+
+    @property
+    def busy(self):
+        ' connections in use plus coroutines waiting for one. '
+        return len(self._used) + len(self._waiters)
+
+    async def _open(self):
+        self._size += 1
+        try:
+            return await self._connect(), time.monotonic()
+        except BaseException:
+            self._size -= 1
+            self._wakeup()
+            raise
+
+    def _discard(self, conn):
+        self._size -= 1
+        try:
+            r = conn.close()
+            if inspect.isawaitable(r):
+                task = asyncio.ensure_future(r)
+                self._closers.add(task)
+                task.add_done_callback(self._closers.discard)
+        except Exception:
+            logging.exception('failed to close connection')
+        self._wakeup()
+
+    def _wakeup(self):
+        # 有连接关闭或者 maxsize 变大了，让一个等待者重新尝试（它可以打开新连接）
+        while self._waiters:
+            fut = self._waiters.popleft()
+            if not fut.done():
+                fut.set_result(None)
+                return
+
+    async def warm_up(self):
+        ' open connections until the pool holds minsize of them. '
+        n = self.minsize - self._size
+        if n <= 0:
+            return
+        opened = await asyncio.gather(*[self._open() for _ in range(n)], return_exceptions=True)
+        now = time.monotonic()
+        for r in opened:
+            if isinstance(r, BaseException):
+                logging.warning('pool warm-up failed: %s', r)
+            else:
+                self._free.append((r[0], r[1], now))
+        logging.info('pool warmed up: %s connections', len(self._free))
+
+    async def acquire(self):
+        start = time.monotonic()
+        deadline = start + self.acquire_timeout
+        while True:
+            if self._closing:
+                raise RuntimeError('pool is closed')
+            conn = await self._take()
+            if conn is None and self._size < self.maxsize:
+                # 建立连接同样受 acquire_timeout 限制，数据库连不上时尽快返回 503
+                try:
+                    conn, created = await asyncio.wait_for(self._open(), max(deadline - time.monotonic(), 0))
+                except asyncio.TimeoutError:
+                    self._observe(self.acquire_timeout)
+                    raise PoolTimeout('could not open a database connection in %ss' % self.acquire_timeout)
+                self._used[conn] = created
+            if conn is None:
+                conn = await self._wait(deadline)
+                if conn is None:
+                    continue
+            self._observe(time.monotonic() - start)
+            return conn
+
+    async def _take(self):
+        # 从空闲连接中取一个可用的，过期或 ping 不通的丢弃
+        while self._free:
+            conn, created, released = self._free.pop()
+            now = time.monotonic()
+            if conn.closed or now - created > self.recycle:
+                self._discard(conn)
+                continue
+            if now - released > self.ping_interval:
+                try:
+                    await conn.ping()
+                except Exception as e:
+                    logging.info('dropping dead connection: %s', e)
+                    self._discard(conn)
+                    continue
+                except BaseException:
+                    # ping 时被取消，连接的状态不确定，关闭它，否则这个连接永远占着 size
+                    self._discard(conn)
+                    raise
+            self._used[conn] = created
+            return conn
+        return None
+
+    async def _wait(self, deadline):
+        fut = asyncio.get_running_loop().create_future()
+        self._waiters.append(fut)
+        try:
+            done, _ = await asyncio.wait((fut,), timeout=max(deadline - time.monotonic(), 0))
+        except BaseException:
+            # 被取消时，连接或重试的通知可能已经交过来了，转给别人
+            if fut.done() and not fut.cancelled() and fut.exception() is None:
+                if fut.result() is not None:
+                    await self.release(fut.result())
+                else:
+                    self._wakeup()
+            fut.cancel()
+            self._forget(fut)
+            raise
+        if not done:
+            fut.cancel()
+            self._forget(fut)
+            self._observe(self.acquire_timeout)
+            raise PoolTimeout('no database connection available in %ss' % self.acquire_timeout)
+        return fut.result()
+
+    def _forget(self, fut):
+        try:
+            self._waiters.remove(fut)
+        except ValueError:
+            pass
+
+    async def release(self, conn):
+        created = self._used.pop(conn)
+        if conn.closed or self._closing or self._size > self.maxsize \
+                or time.monotonic() - created > self.recycle:
+            self._discard(conn)
+            return
+        # 直接交给最早的等待者
+        while self._waiters:
+            fut = self._waiters.popleft()
+            if not fut.done():
+                self._used[conn] = created
+                fut.set_result(conn)
+                return
+        self._free.append((conn, created, time.monotonic()))
+
+    def _observe(self, wait):
+        self.wait = self.wait * 0.8 + wait * 0.2
+        if not self.adaptive:
+            return
+        now = time.monotonic()
+        if now - self._adjusted < self.adaptive_interval:
+            return
+        self._adjusted = now
+        if self.wait > self.adaptive_wait and self.maxsize < self.adaptive_maxsize:
+            # 等待时间长，成倍增大，尽快跟上突增的请求
+            grow = min(max(self.maxsize // 2, 1), self.adaptive_maxsize - self.maxsize)
+            self.maxsize += grow
+            logging.info('pool maxsize grown to %s (wait %.4fs)', self.maxsize, self.wait)
+            for _ in range(grow):
+                self._wakeup()
+        elif self.wait < self.adaptive_wait / 10 and self.maxsize > self.minsize and self._free:
+            # 几乎不用等待，并且有空闲连接，每次缩小一个
+            self.maxsize -= 1
+            if self._size > self.maxsize:
+                self._discard(self._free.popleft()[0])
+
+    def close(self):
+        ' close the idle connections, the ones in use are closed when released. '
+        self._closing = True
+        while self._free:
+            self._discard(self._free.popleft()[0])
+        while self._waiters:
+            fut = self._waiters.popleft()
+            if not fut.done():
+                fut.set_exception(RuntimeError('pool is closed'))
+
+    async def wait_closed(self):
+        while self._size:
+            await asyncio.sleep(0.05)
+        if self._closers:
+            await asyncio.gather(*self._closers, return_exceptions=True)
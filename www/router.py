@@ -0,0 +1,113 @@
+# -*- encoding: utf-8 -*-
+'''
+@File    :   router.py
+@Time    :   2026/10/17 16:20:47
+'''
+
+# here put the import lib
+# 路由表：静态路径用哈希表，带 {param} 的路径用按 / 分段的前缀树（trie）
+# aiohttp 默认的 UrlDispatcher 按路径前缀建立索引，前缀相同的动态路由（例如
+# /api/blogs/{id}/comments 和 /api/blogs/{id}/likes）之间仍然是逐个尝试正则匹配，
+# 路由多了以后查找变慢；这里查找的代价只和路径的段数有关，和路由的数量无关
+# 用法：app = web.Application(router=TrieRouter(), ...)
+# coroweb.add_routes 注册的路由会自动进入路由表；
+# 静态文件、带正则的参数 {id:\d+} 等无法放入路由表的路由，仍由 UrlDispatcher 原来的方式处理
+
+from urllib.parse import unquote
+from aiohttp import web
+from aiohttp.web_urldispatcher import UrlMappingMatchInfo
+
+
+class TrieNode(object):
+
+    __slots__ = ('children', 'param', 'param_node', 'routes')
+
+    def __init__(self):
+        # 静态的下一段 => 子节点
+        self.children = dict()
+        # {param} 段的参数名和子节点，每个节点最多一个
+        self.param = None
+        self.param_node = None
+        # 方法 => aiohttp 的 route
+        self.routes = None
+
+
+def split_path(path):
+    ' split "/a/{b}/c" into segments, None if the path cannot go into the trie. '
+    segments = path[1:].split('/')
+    for seg in segments:
+        if '{' in seg or '}' in seg:
+            # 只支持整段的 {name}，不支持 {name:regex} 或 file{name}.txt
+            if not (seg.startswith('{') and seg.endswith('}')) or ':' in seg or seg.count('{') != 1:
+                return None
+    return segments
+
+
+class TrieRouter(web.UrlDispatcher):
+
+    def __init__(self):
+        super().__init__()
+        # 完整路径 => {方法: route}
+        self._static_routes = dict()
+        self._root = TrieNode()
+
+    def add_route(self, method, path, handler, **kw):
+        route = super().add_route(method, path, handler, **kw)
+        self.index_route(method.upper(), path, route)
+        return route
+
+    def index_route(self, method, path, route):
+        segments = split_path(path)
+        if segments is None:
+            return
+        if not any(seg.startswith('{') for seg in segments):
+            self._static_routes.setdefault(path, dict()).setdefault(method, route)
+            return
+        node = self._root
+        for seg in segments:
+            if seg.startswith('{'):
+                name = seg[1:-1]
+                if node.param_node is None:
+                    node.param = name
+                    node.param_node = TrieNode()
+                elif node.param != name:
+                    # 同一位置的参数名不一致时无法共用节点，交给 UrlDispatcher 处理
+                    return
+                node = node.param_node
+            else:
+                child = node.children.get(seg)
+                if child is None:
+                    child = node.children[seg] = TrieNode()
+                node = child
+        if node.routes is None:
+            node.routes = dict()
+        node.routes.setdefault(method, route)
+
+    def _match(self, node, segments, i, params):
+        if i == len(segments):
+            return node.routes
+        seg = segments[i]
+        child = node.children.get(seg)
+        if child is not None:
+            routes = self._match(child, segments, i + 1, params)
+            if routes:
+                return routes
+        if node.param_node is not None and seg:
+            routes = self._match(node.param_node, segments, i + 1, params)
+            if routes:
+                params[node.param] = unquote(seg)
+                return routes
+        return None
+
+    async def resolve(self, request):
+        method = request.method
+        routes = self._static_routes.get(request.rel_url.path)
+        params = dict()
+        if routes is None:
+            routes = self._match(self._root, request.rel_url.raw_path[1:].split('/'), 0, params)
+        if routes:
+            route = routes.get(method) or routes.get('*')
+            if route is not None:
+                return UrlMappingMatchInfo(params, route)
+        # 没有找到（包括方法不匹配需要返回405的情况），交给 UrlDispatcher
+        return await super().resolve(request)
@@ -0,0 +1,69 @@
+# -*- encoding: utf-8 -*-
+'''
+@File    :   serializer.py
+@Time    :   2026/10/18 09:31:05
+'''
+
+# here put the import lib
+# JSON 编码/解码，请求 body 的解析和 response_factory 返回的 JSON 都经过这里
+# 安装了 orjson 或 ujson 时优先使用（快很多），都没有时使用标准库 json
+# orm.Model 本身就是 dict，各个库都可以直接编码；orm.Row 没有 __dict__，按已赋值的列转换成字典
+
+import json
+import logging
+from orm import Row
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+
+def default(o):
+    # 遇到无法直接编码的对象时调用
+    if isinstance(o, Row):
+        return dict(o.items())
+    return o.__dict__
+
+
+def _orjson_dumps(obj):
+    return orjson.dumps(obj, default=default)
+
+
+def _ujson_dumps(obj):
+    return ujson.dumps(obj, ensure_ascii=False, default=default).encode('utf-8')
+
+
+def _json_dumps(obj):
+    return json.dumps(obj, ensure_ascii=False, default=default).encode('utf-8')
+
+# 名称 => (dumps, loads)，dumps 返回 utf-8 编码的 bytes
+BACKENDS = dict(json=(_json_dumps, json.loads))
+if ujson is not None:
+    BACKENDS['ujson'] = (_ujson_dumps, ujson.loads)
+if orjson is not None:
+    BACKENDS['orjson'] = (_orjson_dumps, orjson.loads)
+
+backend = None
+dumps = None
+loads = None
+
+
+def use(name=None):
+    ' select the json backend by name, or the fastest installed one when name is None. '
+    global backend, dumps, loads
+    if name is None:
+        name = 'orjson' if orjson is not None else 'ujson' if ujson is not None else 'json'
+    if name not in BACKENDS:
+        raise ValueError('JSON backend not installed: %s' % name)
+    backend = name
+    dumps, loads = BACKENDS[name]
+    logging.info('use json backend: %s' % name)
+
+
+use()
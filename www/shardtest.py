@@ -0,0 +1,124 @@
+# -*- encoding: utf-8 -*-
+'''
+@File    :   shardtest.py
+@Time    :   2026/10/19 15:02:17
+'''
+
+# here put the import lib
+# 分片测试：在几个独立的数据库上检查 Comment 按 blog_id 分片后的读写结果
+# 用法：python shardtest.py [分片数] [sqlite]
+# 使用 conf 中 db.shards['comments'] 配置的分片；没有配置时在主库所在的 mysql 上
+# 创建 awesome_c0、awesome_c1 ... 作为分片（需要 create database 权限）
+# 加上 sqlite 时每个分片是一个 sqlite 临时数据库，不需要 mysql
+# 每次运行会清空各分片上的 comments 表
+import os
+import sys
+import random
+import asyncio
+import orm
+from model import Comment, next_id
+
+# conf 在项目根目录下
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from conf.config import configs
+
+
+async def prepare(n, sqlite=False):
+    kw = dict(configs.db)
+    shards = dict(kw.get('shards') or {})
+    if sqlite:
+        kw = dict(backend='sqlite', database=':memory:')
+        shards[Comment.__shards__] = [dict(database=':memory:') for i in range(n)]
+    elif not shards.get(Comment.__shards__):
+        database = kw.get('database', 'awesome')
+        await orm.create_pool(**kw)
+        for i in range(n):
+            await orm.execute('create database if not exists `%s_c%s`' % (database, i), [])
+        await orm.close_pool()
+        shards[Comment.__shards__] = [dict(database='%s_c%s' % (database, i)) for i in range(n)]
+    kw['shards'] = shards
+    await orm.create_pool(**kw)
+    names = orm._shards[Comment.__shards__]
+    for name in names:
+        with orm.use_pool(name):
+            await orm.execute(orm.create_table_sql(Comment), [])
+            await orm.execute('delete from `%s`' % Comment.__table__, [])
+    return names
+
+
+def check(name, ok):
+    print('%-40s %s' % (name, 'ok' if ok else 'FAILED'))
+    if not ok:
+        raise AssertionError(name)
+
+
+async def test(n=4, sqlite=False):
+    names = await prepare(n, sqlite)
+    blogs = [next_id() for _ in range(20)]
+    comments = []
+    for blog_id in blogs:
+        for _ in range(random.randint(1, 15)):
+            comments.append(Comment(id=next_id(), blog_id=blog_id, user_id='u', user_name='test',
+                                    user_image='about:blank', content='comment',
+                                    created_at=random.randint(0, 10 ** 6) + random.random()))
+    await Comment.save_all(comments)
+
+    # 每一行只在分片函数算出的那个分片上
+    placed = True
+    for i, name in enumerate(names):
+        with orm.use_pool(name):
+            rs = await orm.select('select `id`, `blog_id` from `comments`', [])
+        placed = placed and all(Comment.__shard_fn__(r['blog_id'], len(names)) == i for r in rs)
+    check('rows placed by shard key', placed)
+    check('rows spread over shards', len(set(Comment.__shard_fn__(b, len(names)) for b in blogs)) > 1)
+
+    by_blog = [c for c in comments if c.blog_id == blogs[0]]
+    rs = await Comment.findAll('blog_id=?', [blogs[0]], orderBy='created_at')
+    check('findAll routed by shard key',
+          [r.id for r in rs] == [c.id for c in sorted(by_blog, key=lambda c: c.created_at)])
+
+    ordered = sorted(comments, key=lambda c: c.created_at, reverse=True)
+    rs = await Comment.findAll(orderBy='created_at desc', limit=15)
+    check('scatter-gather order by + limit', [r.id for r in rs] == [c.id for c in ordered[:15]])
+    rs = await Comment.findAll(orderBy='created_at desc', limit=(10, 5))
+    check('scatter-gather limit offset', [r.id for r in rs] == [c.id for c in ordered[10:15]])
+
+    check('findNumber across shards', await Comment.findNumber('count(id)') == len(comments))
+    check('findNumber on one shard', await Comment.findNumber('count(id)', 'blog_id=?', [blogs[0]]) == len(by_blog))
+    check('max across shards', await Comment.findNumber('max(created_at)') == ordered[0].created_at)
+
+    c = random.choice(comments)
+    check('find by primary key', (await Comment.find(c.id)).blog_id == c.blog_id)
+
+    ids, cursor = [], None
+    while True:
+        page, cursor = await Comment.findPage(limit=7, cursor=cursor)
+        ids.extend(r.id for r in page)
+        if cursor is None:
+            break
+    expected = sorted(comments, key=lambda c: (c.created_at, c.id), reverse=True)
+    check('findPage across shards', ids == [c.id for c in expected])
+
+    ids, cursor = [], None
+    while True:
+        page, cursor = await Comment.findPage('blog_id=?', [blogs[0]], limit=3, cursor=cursor)
+        ids.extend(r.id for r in page)
+        if cursor is None:
+            break
+    check('findPage routed by shard key', ids == [c.id for c in expected if c.blog_id == blogs[0]])
+
+    c.content = 'updated'
+    await c.update()
+    check('update on its shard', (await Comment.find(c.id)).content == 'updated')
+    r = await Comment.find(c.id, fields=['content'])
+    r.content = 'updated again'
+    await r.update()
+    check('update without shard key', (await Comment.find(c.id)).content == 'updated again')
+    await c.remove()
+    check('remove', await Comment.find(c.id) is None)
+
+    await orm.close_pool()
+
+
+if __name__ == '__main__':
+    asyncio.run(test(int(sys.argv[1]) if len(sys.argv) > 1 else 4, 'sqlite' in sys.argv[2:]))
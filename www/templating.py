@@ -0,0 +1,103 @@
+# -*- encoding: utf-8 -*-
+'''
+@File    :   templating.py
+@Time    :   2026/10/17 17:02:18
+'''
+
+# here put the import lib
+# jinja2 的片段缓存：把渲染代价高的一段模版（例如博客列表）渲染一次后缓存起来
+# 模版中的写法：
+#     {% cache 'blogs' %} ... {% endcache %}              使用默认有效期
+#     {% cache 'blogs', 300 %} ... {% endcache %}         有效期 300 秒
+#     {% cache 'blogs', 300, page %} ... {% endcache %}   后面的参数用来区分同一片段的不同版本
+# 数据变化后在代码中主动失效：
+#     app['__templating__'].fragment_cache.invalidate('blogs')
+# 渲染是同步的，所以这里用一个同步的进程内缓存，而不是 cache.py 中的协程接口
+
+import time
+from collections import OrderedDict
+from jinja2 import nodes
+from jinja2.ext import Extension
+
+
+class FragmentCache(object):
+    '''
+    in-process LRU store of rendered fragments, grouped by fragment name.
+    '''
+
+    def __init__(self, maxsize=1024, ttl=60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+
+    def get(self, name, vary):
+        k = (name, vary)
+        entry = self._data.get(k)
+        if entry is None:
+            return None
+        value, expires = entry
+        if expires < time.monotonic():
+            del self._data[k]
+            return None
+        self._data.move_to_end(k)
+        return value
+
+    def set(self, name, vary, value, ttl=None):
+        k = (name, vary)
+        self._data[k] = (value, time.monotonic() + (self.ttl if ttl is None else ttl))
+        self._data.move_to_end(k)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def invalidate(self, name=None):
+        ' drop every version of the named fragment, or all fragments when name is None. '
+        if name is None:
+            self._data.clear()
+            return
+        for k in [k for k in self._data if k[0] == name]:
+            del self._data[k]
+
+
+def vary_key(value):
+    ' make a hashable cache key from a vary argument. '
+    # Model / Row 按 (表名, 主键) 区分；dict、list 这类无法 hash 的值用 repr
+    pk = getattr(value, '__primary_key__', None)
+    if pk is not None:
+        return (value.__table__, value.getValue(pk))
+    try:
+        hash(value)
+    except TypeError:
+        return repr(value)
+    return value
+
+
+class FragmentCacheExtension(Extension):
+
+    tags = set(['cache'])
+
+    def __init__(self, environment):
+        super().__init__(environment)
+        environment.extend(fragment_cache=FragmentCache())
+
+    def parse(self, parser):
+        lineno = next(parser.stream).lineno
+        # 片段名，可选的有效期，其余的参数都作为区分版本的 key
+        name = parser.parse_expression()
+        ttl = nodes.Const(None)
+        vary = []
+        if parser.stream.skip_if('comma'):
+            ttl = parser.parse_expression()
+            while parser.stream.skip_if('comma'):
+                vary.append(parser.parse_expression())
+        body = parser.parse_statements(['name:endcache'], drop_needle=True)
+        args = [name, ttl, nodes.Tuple(vary, 'load')]
+        return nodes.CallBlock(self.call_method('_render_cached', args), [], [], body).set_lineno(lineno)
+
+    def _render_cached(self, name, ttl, vary, caller):
+        cache = self.environment.fragment_cache
+        vary = tuple(vary_key(v) for v in vary)
+        rv = cache.get(name, vary)
+        if rv is None:
+            rv = caller()
+            cache.set(name, vary, rv, ttl)
+        return rv
@@ -10,23 +10,25 @@
 # 测试使用ORM连接数据库能否成功
 # 通过在mysql中，登陆webapp，使用awesome数据库
 # 查询语句 SELECT * FROM users;
+import os
+import sys
 import asyncio
 import orm
 from model import User, Blog, Comment
 
+# conf 在项目根目录下
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from conf.config import configs
 
-async def test(loop):
-    await orm.create_pool(loop=loop,
-                          user='webapp', password='0506', db='awesome')
+
+async def test():
+    await orm.create_pool(**configs.db)
 
     u = User(name='Test', email='test@example.com',
              passwd='123456', image='about:blank')
     
     await u.save()
-    orm.__pool.close()
-    await orm.__pool.wait_closed()
+    await orm.close_pool()
 
 if __name__ == '__main__':
-    loop = asyncio.get_event_loop()
-    loop.run_until_complete(test(loop))
-    loop.close()
+    asyncio.run(test())